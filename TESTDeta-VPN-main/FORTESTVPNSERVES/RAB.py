@@ -1,20 +1,179 @@
+import argparse
+import asyncio
 import logging
-from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+import os
+import secrets
+import signal
+import sys
+from aiohttp import web
+from aiogram import Bot
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.utils import executor
-from config import API_TOKEN
-from database import init_db
+from config import (API_TOKEN, TELEGRAM_API_SERVER, RUN_MODE, WEBHOOK_HOST, WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT,
+                    WEBHOOK_SECRET, WEBHOOK_SHUTDOWN_TIMEOUT, WEBHOOK_MAX_CONNECTIONS, METRICS_HOST, METRICS_PORT,
+                    SCHEDULER_SHUTDOWN_TIMEOUT, WORKERS, CLUSTER_SOCKET_PATH)
+from database import init_db, close_db, stop_registration_writer, start_config_pool_refill, stop_config_pool_refill
 from handlers import register_handlers
+from storage import SQLiteStorage
+from metrics import MetricsMiddleware, start_metrics_server
+from throttling import ThrottlingMiddleware
+from scheduler import SchedulingDispatcher
+from broadcast import resume_broadcast_jobs, stop_broadcast_jobs
+from cluster import ShardRouter, serve_worker
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Инициализация бота
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
+server = TelegramAPIServer.from_base(TELEGRAM_API_SERVER) if TELEGRAM_API_SERVER else TELEGRAM_PRODUCTION
+bot = Bot(token=API_TOKEN, server=server)
+storage = SQLiteStorage()
+dp = SchedulingDispatcher(bot, storage=storage)
+webhook_secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+metrics_runner = None
 
-if __name__ == '__main__':
+async def on_startup(dp):
+    """Запуск сервера метрик, пополнения пула конфигов и возобновление рассылок, прерванных перезапуском."""
+    global metrics_runner
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    start_config_pool_refill()
+    await resume_broadcast_jobs(dp.bot)
+
+async def on_shutdown(dp):
+    """Сохранение прогресса рассылок и регистраций, закрытие пула соединений с базой данных при остановке бота."""
+    if dp.is_polling():
+        # Executor вызывает on_shutdown до stop_polling: сначала перестаём получать обновления
+        # (текущий getUpdates дожидается ответа), затем дообрабатываем принятые
+        dp.stop_polling()
+        await dp.wait_closed()
+    await dp.scheduler.close(SCHEDULER_SHUTDOWN_TIMEOUT)  # Дообрабатываем уже принятые обновления
+    await stop_broadcast_jobs()
+    await stop_registration_writer()
+    await stop_config_pool_refill()
+    await dp.storage.close()  # Дописываем состояния FSM до закрытия пула
+    close_db()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+async def on_startup_webhook(dp):
+    """Регистрация вебхука в Telegram (накопившиеся обновления не сбрасываются)."""
+    await dp.bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH, secret_token=webhook_secret, drop_pending_updates=False,
+                             max_connections=WEBHOOK_MAX_CONNECTIONS)
+    await on_startup(dp)
+
+async def on_shutdown_webhook(dp):
+    """Снятие вебхука: обновления, пришедшие во время простоя, Telegram отдаст после следующего запуска."""
+    await dp.bot.delete_webhook()
+    await on_shutdown(dp)
+
+@web.middleware
+async def check_webhook_secret(request, handler):
+    """Отклонение запросов на вебхук без правильного секретного токена."""
+    if request.path == WEBHOOK_PATH and \
+            not secrets.compare_digest(request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), webhook_secret):
+        logging.warning(f"Запрос на вебхук с неверным секретом от {request.remote}")
+        return web.Response(status=403)
+    return await handler(request)
+
+def run_webhook():
+    """Запуск aiohttp-сервера для приёма обновлений через вебхук."""
+    app = web.Application(middlewares=[check_webhook_secret])
+    webhook = executor.set_webhook(dp, WEBHOOK_PATH, on_startup=on_startup_webhook,
+                                   on_shutdown=on_shutdown_webhook, web_app=app)
+    # aiohttp сначала перестаёт принимать соединения и дожидается обрабатываемых запросов,
+    # затем вызывает on_shutdown
+    webhook.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT, shutdown_timeout=WEBHOOK_SHUTDOWN_TIMEOUT)
+
+def setup_dispatcher():
     init_db()  # Инициализация базы данных
+    dp.middleware.setup(MetricsMiddleware())  # Замер времени обработчиков
+    dp.middleware.setup(ThrottlingMiddleware())  # Антифлуд
     register_handlers(dp)  # Регистрация обработчиков
-    executor.start_polling(dp, skip_updates=True)
\ No newline at end of file
+
+def run_worker(index):
+    """Процесс-воркер: обработчики на своём диспетчере, обновления приходят от приёмника.
+
+    Пополнение пула конфигов и рассылки запускаются только на воркере 0 (туда же попадают админы).
+    """
+    async def on_startup_worker(dp):
+        global metrics_runner
+        if METRICS_PORT:
+            metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT + 1 + index)
+        if index == 0:
+            start_config_pool_refill()
+            await resume_broadcast_jobs(dp.bot)
+
+    async def on_shutdown_worker(dp):
+        await on_shutdown(dp)
+        await (await dp.bot.get_session()).close()
+
+    setup_dispatcher()
+    asyncio.run(serve_worker(dp, index, CLUSTER_SOCKET_PATH, on_startup_worker, on_shutdown_worker))
+
+def run_front():
+    """Приёмник обновлений: раздаёт их WORKERS воркерам по хэшу user_id и перезапускает упавших.
+
+    kill -HUP — поочерёдный перезапуск воркеров (например, после обновления кода) без потери обновлений.
+    """
+    init_db()  # Миграции — один раз, до запуска воркеров
+    close_db()
+    router = ShardRouter(WORKERS, CLUSTER_SOCKET_PATH,
+                         lambda index: [sys.executable, os.path.abspath(__file__), '--worker', str(index)])
+
+    async def start(app=None):
+        global metrics_runner
+        if METRICS_PORT:
+            metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        await router.start()
+
+    async def stop(app=None):
+        await router.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await (await bot.get_session()).close()
+
+    if RUN_MODE == 'webhook':
+        async def set_webhook(app):
+            await bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH, secret_token=webhook_secret, drop_pending_updates=False,
+                                  max_connections=WEBHOOK_MAX_CONNECTIONS)
+
+        async def delete_webhook(app):
+            await bot.delete_webhook()
+
+        app = web.Application(middlewares=[check_webhook_secret])
+        app.router.add_post(WEBHOOK_PATH, router.handle_webhook)
+        app.on_startup.extend([start, set_webhook])
+        app.on_shutdown.append(delete_webhook)
+        # Воркеры останавливаются после того, как aiohttp дождался ответов на принятые вебхуки
+        app.on_cleanup.append(stop)
+        web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, shutdown_timeout=WEBHOOK_SHUTDOWN_TIMEOUT)
+    else:
+        async def run_polling():
+            await start()
+            polling = asyncio.create_task(router.poll(bot, skip_updates=True))
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, polling.cancel)
+            try:
+                await polling
+            except asyncio.CancelledError:
+                pass
+            await stop()
+
+        asyncio.run(run_polling())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="VPN-бот")
+    parser.add_argument('--worker', type=int, default=None, help="Запуск воркера с этим номером (запускает приёмник)")
+    args = parser.parse_args()
+    if args.worker is not None:
+        run_worker(args.worker)
+    elif WORKERS > 1:
+        run_front()
+    else:
+        setup_dispatcher()
+        if RUN_MODE == 'webhook':
+            run_webhook()
+        else:
+            executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
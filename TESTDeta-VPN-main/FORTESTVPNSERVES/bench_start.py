@@ -0,0 +1,156 @@
+"""
+Микробенчмарк /start: пропускная способность обработчика и задержки event loop.
+
+В отличие от loadtest.py использует только database.init_db и handlers.register_handlers,
+поэтому запускается и на ревизиях до перевода базы на пул потоков — так сравниваются /start до и после:
+    python bench_start.py
+    git worktree add /tmp/bot-before <ревизия>
+    cp bench_start.py /tmp/bot-before/TESTDeta-VPN-main/FORTESTVPNSERVES/
+    python /tmp/bot-before/TESTDeta-VPN-main/FORTESTVPNSERVES/bench_start.py
+
+Обновления подаются пачками по --batch (как их отдаёт getUpdates в polling) на временной базе,
+заглушка Bot API работает в отдельном потоке со своим event loop. Два прохода: регистрация
+--users новых пользователей и повторный /start тех же пользователей. Для каждого — /start в секунду,
+медиана и 95-й перцентиль обработки обновления и самая долгая задержка event loop (пока обработчик
+держит loop синхронным запросом к базе, остальные чаты стоят).
+"""
+import argparse
+import asyncio
+import inspect
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from aiohttp import web
+
+FAKE_TOKEN = '123456789:BENCH-token-for-fake-telegram-api'
+LAG_INTERVAL = 0.005  # Период проверки задержки event loop, секунд
+
+def _start_fake_api(port, latency):
+    """Заглушка Bot API в отдельном потоке: отвечает на sendMessage через latency секунд."""
+    message_ids = itertools.count(1)
+
+    async def handle(request):
+        params = dict(await request.post()) if request.can_read_body else {}
+        if latency:
+            await asyncio.sleep(latency)
+        if request.match_info['method'] == 'sendMessage':
+            return web.json_response({'ok': True, 'result': {
+                'message_id': next(message_ids), 'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'}, 'text': params.get('text', '')}})
+        return web.json_response({'ok': True, 'result': True})
+
+    started = threading.Event()
+    errors = []
+
+    def run():
+        loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', handle)
+        runner = web.AppRunner(app, access_log=None)
+        try:
+            loop.run_until_complete(runner.setup())
+            loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+        except OSError as e:
+            errors.append(e)
+            return
+        finally:
+            started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    if errors:
+        raise errors[0]
+
+def _start_update(update_id, user_id):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'},
+        'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}}
+
+async def _watch_lag(lags):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(time.perf_counter() - started - LAG_INTERVAL)
+
+async def _run_pass(dp, types, user_ids, batch, update_ids):
+    durations, lags = [], []
+
+    async def process(update):
+        started = time.perf_counter()
+        await dp.process_update(update)
+        durations.append(time.perf_counter() - started)
+
+    watcher = asyncio.create_task(_watch_lag(lags))
+    started = time.perf_counter()
+    for i in range(0, len(user_ids), batch):
+        updates = [types.Update.to_object(_start_update(next(update_ids), user_id))
+                   for user_id in user_ids[i:i + batch]]
+        await asyncio.gather(*(process(update) for update in updates))
+    elapsed = time.perf_counter() - started
+    watcher.cancel()
+    durations.sort()
+    return {
+        'rate': len(user_ids) / elapsed,
+        'p50': durations[len(durations) // 2],
+        'p95': durations[int(len(durations) * 0.95)],
+        'max_lag': max(lags, default=0.0),
+    }
+
+async def _bench(args):
+    from aiogram import Bot, Dispatcher, types
+    from aiogram.bot.api import TelegramAPIServer
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+    import database
+    from handlers import register_handlers
+
+    database.init_db()
+    bot = Bot(token=FAKE_TOKEN, server=TelegramAPIServer.from_base(f'http://127.0.0.1:{args.api_port}'))
+    dp = Dispatcher(bot, storage=MemoryStorage())
+    register_handlers(dp)
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    user_ids = list(range(1_000_001, 1_000_001 + args.users))
+    update_ids = itertools.count(1)
+    try:
+        results = {}
+        for name in ('new', 'repeat'):
+            results[name] = await _run_pass(dp, types, user_ids, args.batch, update_ids)
+    finally:
+        # Ревизии с пулом потоков дописывают регистрации и закрывают соединения
+        for name in ('stop_registration_writer', 'close_db'):
+            shutdown = getattr(database, name, None)
+            if shutdown is not None:
+                result = shutdown()
+                if inspect.isawaitable(result):
+                    await result
+        await (await bot.get_session()).close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк /start на временной базе с заглушкой Bot API")
+    parser.add_argument('--users', type=int, default=500,
+                        help="Пользователей в каждом проходе (на первых ревизиях всего 900 VPN ID)")
+    parser.add_argument('--batch', type=int, default=100, help="Обновлений, обрабатываемых одновременно")
+    parser.add_argument('--latency', type=float, default=50, help="Задержка ответа заглушки, мс")
+    parser.add_argument('--api-port', type=int, default=8191)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    _start_fake_api(args.api_port, args.latency / 1000)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # База users.db создаётся во временном каталоге
+        results = asyncio.run(_bench(args))
+    print(f"/start, {args.users} пользователей, пачки по {args.batch}, задержка API {args.latency:g} мс")
+    for name, result in results.items():
+        print(f"  {name:<7} {result['rate']:8.0f} /с   p50 {result['p50'] * 1000:7.1f} мс   "
+              f"p95 {result['p95'] * 1000:7.1f} мс   макс. задержка loop {result['max_lag'] * 1000:7.1f} мс")
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
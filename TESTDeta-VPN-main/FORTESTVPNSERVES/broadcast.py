@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import time
+from aiogram import Bot
+from aiogram.utils.exceptions import (RetryAfter, TelegramAPIError, MessageNotModified, BotBlocked, BotKicked,
+                                      ChatNotFound, UserDeactivated, CantInitiateConversation)
+from cluster import invalidate
+from config import (BROADCAST_RATE, BROADCAST_BURST, BROADCAST_CONCURRENCY, BROADCAST_MAX_RETRIES,
+                    BROADCAST_PROGRESS_INTERVAL, BROADCAST_BATCH_SIZE, BROADCAST_FLUSH_SIZE)
+from database import (get_broadcast_job, get_unfinished_broadcast_jobs, get_broadcast_recipients,
+                      save_broadcast_progress, set_broadcast_job_status)
+from keyboards import get_broadcast_keyboard
+from metrics import inc
+
+# Ошибки, после которых пользователь помечается как недоступный и исключается из следующих рассылок
+UNREACHABLE_ERRORS = (BotBlocked, BotKicked, ChatNotFound, UserDeactivated, CantInitiateConversation)
+
+_bucket = None
+_job_tasks = {}  # job_id -> asyncio.Task
+_job_states = {}  # job_id -> 'running' / 'paused' / 'cancelled' / 'stopping'
+
+class TokenBucket:
+    """Глобальное ведро токенов: ограничивает скорость отправки для всех воркеров рассылки."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ожидание одного токена (с учётом паузы после RetryAfter)."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def block(self, seconds):
+        """Приостановка выдачи токенов всем воркерам (Telegram вернул 429)."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+def get_bucket():
+    """Общее для всех заданий рассылки ведро токенов."""
+    global _bucket
+    if _bucket is None:
+        _bucket = TokenBucket(BROADCAST_RATE, BROADCAST_BURST)
+    return _bucket
+
+def format_progress(job_id, stats, total):
+    """Текст прогресса рассылки: отправлено/ошибок/осталось и оценка оставшегося времени."""
+    done = stats["sent"] + stats["failed"]
+    remaining = max(total - done, 0)
+    elapsed = time.monotonic() - stats["started_at"]
+    done_now = done - stats["start_done"]
+    if done_now > 0 and remaining:
+        eta = f"{int(elapsed / done_now * remaining)} с"
+    else:
+        eta = "—"
+    return (
+        f"Рассылка #{job_id}: {done}/{total}\n"
+        f"Отправлено: {stats['sent']}\n"
+        f"Ошибок: {stats['failed']}\n"
+        f"Осталось: {remaining}\n"
+        f"Осталось времени: {eta}"
+    )
+
+async def send_broadcast_message(bot: Bot, bucket: TokenBucket, user_id, text, photo=None, keyboard=None):
+    """Отправка одного сообщения рассылки с повтором после RetryAfter.
+
+    Возвращает None при успехе или исключение последней неудачной попытки.
+    """
+    for _ in range(BROADCAST_MAX_RETRIES + 1):
+        await bucket.acquire()
+        try:
+            if photo:
+                await bot.send_photo(chat_id=user_id, photo=photo, caption=text, reply_markup=keyboard)
+            else:
+                await bot.send_message(chat_id=user_id, text=text, reply_markup=keyboard)
+            return None
+        except RetryAfter as e:
+            logging.warning(f"Flood control при рассылке, пауза {e.timeout} с")
+            inc("broadcast_messages_total", "retry_after")
+            bucket.block(e.timeout)
+            error = e
+        except (TelegramAPIError, asyncio.TimeoutError, OSError) as e:
+            return e
+    return error
+
+async def _edit_progress(message, job, stats):
+    try:
+        await message.edit_text(format_progress(job["id"], stats, job["total"]))
+    except MessageNotModified:
+        pass
+    except TelegramAPIError as e:
+        logging.error(f"Ошибка обновления прогресса рассылки: {e}")
+
+async def _report_progress(message, job, stats):
+    while True:
+        await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+        await _edit_progress(message, job, stats)
+
+async def run_broadcast_job(bot: Bot, job_id):
+    """Выполнение (или продолжение) задания рассылки с последнего записанного курсора.
+
+    Получатели выбираются порциями по user_id, результаты пишутся в БД пакетами,
+    после каждой порции курсор сдвигается. Задание останавливается, как только
+    его статус в _job_states перестаёт быть 'running' (пауза, отмена или остановка бота).
+    Возвращает True, если получатели закончились (задание выполнено).
+    """
+    job = await get_broadcast_job(job_id)
+    if job is None:
+        return True
+    await set_broadcast_job_status(job_id, 'running')
+    bucket = get_bucket()
+    keyboard = get_broadcast_keyboard(job["url"])
+    stats = {
+        "sent": job["sent"],
+        "failed": job["failed"],
+        "start_done": job["sent"] + job["failed"],
+        "started_at": time.monotonic()
+    }
+    pending = []
+    finished = False
+    blocked = []  # Отмечены недоступными в текущей порции (о них узнают остальные воркеры)
+    recorded = []  # user_id порции, результат доставки которых уже в pending
+    cursor = job["cursor"]
+
+    async def flush(new_cursor=None):
+        batch = pending[:]
+        pending.clear()
+        if batch or new_cursor is not None:
+            await save_broadcast_progress(job_id, batch, new_cursor)
+
+    async def worker(recipients):
+        # Состояние проверяется до того, как взять следующего получателя: взятый получатель
+        # всегда отправляется и записывается, иначе курсор мог бы его перескочить
+        while _job_states.get(job_id) == 'running':
+            user_id = next(recipients, None)
+            if user_id is None:
+                return
+            error = await send_broadcast_message(bot, bucket, user_id, job["text"], job["photo"], keyboard)
+            if error is None:
+                stats["sent"] += 1
+                inc("broadcast_messages_total", "sent")
+                pending.append((user_id, None, False))
+            elif isinstance(error, UNREACHABLE_ERRORS):
+                stats["failed"] += 1
+                inc("broadcast_messages_total", "blocked")
+                pending.append((user_id, str(error), True))
+                blocked.append(user_id)
+                logging.info(f"Пользователь {user_id} недоступен: {error}")
+            else:
+                stats["failed"] += 1
+                inc("broadcast_messages_total", "failed")
+                pending.append((user_id, str(error), False))
+                logging.error(f"Ошибка отправки сообщения пользователю {user_id}: {error}")
+            recorded.append(user_id)
+            if len(pending) >= BROADCAST_FLUSH_SIZE:
+                await flush()
+
+    progress_message = None
+    progress_task = None
+    if job["admin_chat_id"]:
+        try:
+            progress_message = await bot.send_message(job["admin_chat_id"], format_progress(job_id, stats, job["total"]))
+            progress_task = asyncio.create_task(_report_progress(progress_message, job, stats))
+        except TelegramAPIError as e:
+            logging.error(f"Ошибка отправки прогресса рассылки: {e}")
+
+    try:
+        while _job_states.get(job_id) == 'running':
+            user_ids = await get_broadcast_recipients(job_id, cursor, BROADCAST_BATCH_SIZE)
+            if user_ids is None:
+                # Ошибка БД: ставим задание на паузу, чтобы админ мог продолжить его вручную
+                _job_states[job_id] = 'paused'
+                break
+            if not user_ids:
+                finished = True
+                break
+            recipients = iter(user_ids)
+            recorded.clear()
+            await asyncio.gather(*(worker(recipients) for _ in range(min(BROADCAST_CONCURRENCY, len(user_ids)))))
+            # Получатели берутся по возрастанию user_id, и каждый взятый записан, поэтому курсор
+            # сдвигается до самого большого записанного (пауза и продолжение внутри порции его не перескочат)
+            if recorded and _job_states.get(job_id) == 'running':
+                cursor = max(recorded)
+                await flush(cursor)
+            if blocked:
+                invalidate('blocked', blocked[:])
+                blocked.clear()
+    finally:
+        if progress_task is not None:
+            progress_task.cancel()
+        await flush()
+
+    # Если задание продолжили, пока оно останавливалось (state снова 'running', но получатели
+    # не закончились), статус не трогаем: _forget_job запустит его заново
+    state = _job_states.get(job_id)
+    if finished and state == 'running':
+        await set_broadcast_job_status(job_id, 'done')
+    elif state in ('paused', 'cancelled'):
+        await set_broadcast_job_status(job_id, state)
+    if progress_message is not None:
+        await _edit_progress(progress_message, job, stats)
+    if finished and state == 'running' and job["admin_chat_id"]:
+        try:
+            await bot.send_message(job["admin_chat_id"],
+                                   f"Рассылка #{job_id} завершена. Отправлено {stats['sent']} сообщений, ошибок: {stats['failed']}.")
+        except TelegramAPIError as e:
+            logging.error(f"Ошибка отправки итогов рассылки: {e}")
+    return finished
+
+def start_broadcast_job(bot: Bot, job_id):
+    """Запуск задания рассылки в фоне (если оно ещё не выполняется)."""
+    task = _job_tasks.get(job_id)
+    if task is not None and not task.done():
+        _job_states[job_id] = 'running'
+        return
+    _job_states[job_id] = 'running'
+    task = asyncio.create_task(run_broadcast_job(bot, job_id))
+    _job_tasks[job_id] = task
+    task.add_done_callback(lambda t: _forget_job(bot, job_id, t))
+
+def _forget_job(bot: Bot, job_id, task):
+    if _job_tasks.get(job_id) is not task:
+        return
+    del _job_tasks[job_id]
+    state = _job_states.pop(job_id, None)
+    if task.cancelled():
+        return
+    if task.exception() is not None:
+        logging.error(f"Задание рассылки #{job_id} завершилось с ошибкой: {task.exception()}")
+    elif state == 'running' and not task.result():
+        # Продолжение пришло, когда задание уже выходило из цикла
+        start_broadcast_job(bot, job_id)
+
+async def pause_broadcast_job(job_id):
+    """Пауза задания: воркеры останавливаются, прогресс записывается в БД.
+
+    False, если задание уже завершено или отменено (или ошибка БД).
+    """
+    if not await set_broadcast_job_status(job_id, 'paused'):
+        return False
+    if job_id in _job_tasks:
+        _job_states[job_id] = 'paused'
+    return True
+
+async def resume_broadcast_job(bot: Bot, job_id):
+    """Продолжение задания с последнего записанного курсора."""
+    job = await get_broadcast_job(job_id)
+    if job is None or job["status"] not in ('pending', 'paused', 'running'):
+        return False
+    await set_broadcast_job_status(job_id, 'running')
+    start_broadcast_job(bot, job_id)
+    return True
+
+async def cancel_broadcast_job(job_id):
+    """Отмена задания рассылки. False, если задание уже завершено или отменено (или ошибка БД)."""
+    if not await set_broadcast_job_status(job_id, 'cancelled'):
+        return False
+    if job_id in _job_tasks:
+        _job_states[job_id] = 'cancelled'
+    return True
+
+async def resume_broadcast_jobs(bot: Bot):
+    """Возобновление незавершённых заданий после перезапуска бота (задания на паузе не трогаются)."""
+    for job in await get_unfinished_broadcast_jobs():
+        if job["status"] in ('pending', 'running'):
+            logging.info(f"Возобновление рассылки #{job['id']} с user_id > {job['cursor']}")
+            start_broadcast_job(bot, job["id"])
+
+async def stop_broadcast_jobs():
+    """Остановка выполняющихся заданий при выключении бота: прогресс сохраняется, статус остаётся 'running'."""
+    for job_id in list(_job_tasks):
+        _job_states[job_id] = 'stopping'
+    tasks = list(_job_tasks.values())
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,346 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+import signal
+import zlib
+from collections import OrderedDict
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+from config import ADMIN_IDS, CLUSTER_MAX_UNACKED, SCHEDULER_SHUTDOWN_TIMEOUT, WORKER_RESTART_DELAY
+from metrics import inc, register_gauge
+
+_invalidation_handlers = {}  # событие -> [функции сброса кэша]
+_front_writer = None  # Соединение воркера с приёмником (None — бот работает одним процессом)
+
+def _encode(message):
+    return json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+
+def shard_for(user_id, workers):
+    """Номер воркера для пользователя.
+
+    Все обновления пользователя попадают в один процесс, поэтому его состояние FSM, антифлуд
+    и кэш internal_id остаются согласованными. Админы всегда на воркере 0: там же выполняются
+    рассылки и пополнение пула конфигов, которыми они управляют.
+    """
+    if user_id in ADMIN_IDS:
+        return 0
+    return zlib.crc32(user_id.to_bytes(8, 'little', signed=True)) % workers
+
+def _update_user_id(update):
+    """user_id отправителя обновления (dict из JSON Bot API); id чата, если отправителя нет."""
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user') or value.get('chat')
+            if user:
+                return user.get('id')
+    return None
+
+def on_invalidate(event, handler):
+    """Регистрация сброса кэша процесса: handler вызывается, когда событие прислал другой воркер.
+
+    Если событие пришло с данными (invalidate(event, data)), они передаются handler аргументом.
+    """
+    _invalidation_handlers.setdefault(event, []).append(handler)
+
+def invalidate(event, data=None):
+    """Сообщение остальным воркерам, что данные event изменились.
+
+    data — что именно изменилось (должно сериализоваться в JSON), чтобы воркеры обновили кэш
+    точечно, а не перечитывали его целиком. Свой кэш вызывающий код обновляет сам;
+    в одном процессе функция ничего не делает.
+    """
+    if _front_writer is not None and not _front_writer.is_closing():
+        message = {'invalidate': event}
+        if data is not None:
+            message['data'] = data
+        _front_writer.write(_encode(message))
+
+async def _apply_invalidation(event, data=None):
+    for handler in _invalidation_handlers.get(event, []):
+        try:
+            result = handler() if data is None else handler(data)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logging.error(f"Ошибка сброса кэша по событию {event}: {e}")
+
+class _Shard:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.writer = None  # Соединение с текущим процессом воркера
+        self.generation = 0  # Сколько раз воркер подключался (растёт с каждым новым процессом)
+        self.connected = asyncio.Condition()
+        self.unacked = OrderedDict()  # update_id -> (строка для воркера, future) в порядке получения
+        self.restart_requested = False
+
+class ShardRouter:
+    """
+    Приёмник обновлений для нескольких процессов-воркеров.
+
+    Обновления раздаются воркерам по хэшу user_id (shard_for) через Unix-сокет, по одной строке JSON.
+    Обновление хранится у приёмника, пока воркер не подтвердит, что обработал его: после падения
+    или перезапуска воркера неподтверждённые обновления отправляются новому процессу в прежнем порядке.
+    Через приёмник же воркеры рассылают друг другу события сброса кэшей (invalidate).
+    """
+
+    def __init__(self, workers, socket_path, command):
+        self.workers = workers
+        self.socket_path = socket_path
+        self.command = command  # номер воркера -> аргументы запуска процесса
+        self._shards = [_Shard(index) for index in range(workers)]
+        self._server = None
+        self._supervisors = []
+        self._restart_task = None
+        self._closing = False
+        self._acked = asyncio.Event()  # Воркер подтвердил обновление (ждёт poll при переполнении)
+        register_gauge("cluster_unacked", lambda: {str(shard.index): len(shard.unacked) for shard in self._shards},
+                       "Обновлений, ещё не подтверждённых воркером, по воркерам")
+
+    async def start(self):
+        """Запуск воркеров; возвращается, когда все они подключились. SIGHUP — поочерёдный перезапуск воркеров."""
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._handle_worker, self.socket_path)
+        self._supervisors = [asyncio.create_task(self._supervise(shard)) for shard in self._shards]
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self._request_restart)
+        for shard in self._shards:
+            async with shard.connected:
+                await shard.connected.wait_for(lambda: shard.generation > 0)
+
+    async def _supervise(self, shard):
+        """Запуск процесса воркера и перезапуск после его выхода (кроме остановки приёмника)."""
+        while not self._closing:
+            # Своя группа процессов: Ctrl+C в терминале получает только приёмник, воркеров он останавливает сам
+            shard.process = await asyncio.create_subprocess_exec(*self.command(shard.index), start_new_session=True)
+            if self._closing:
+                shard.process.terminate()
+            code = await shard.process.wait()
+            # Дочитываем подтверждения старого процесса, прежде чем новый получит неподтверждённые обновления
+            while shard.writer is not None:
+                await asyncio.sleep(0.05)
+            if self._closing:
+                break
+            if shard.restart_requested:
+                shard.restart_requested = False
+                continue
+            logging.error(f"Воркер {shard.index} завершился с кодом {code}, перезапуск через {WORKER_RESTART_DELAY} с")
+            inc("cluster_worker_restarts", str(shard.index))
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+
+    async def _handle_worker(self, reader, writer):
+        try:
+            shard = self._shards[json.loads(await reader.readline())['worker']]
+        except (ValueError, KeyError, IndexError, TypeError, ConnectionError) as e:
+            logging.error(f"Некорректное подключение к сокету воркеров: {e}")
+            writer.close()
+            return
+        shard.writer = writer
+        for line, _ in shard.unacked.values():
+            writer.write(line)
+        if shard.unacked:
+            logging.info(f"Воркер {shard.index}: повторно отправлено обновлений: {len(shard.unacked)}")
+        async with shard.connected:
+            shard.generation += 1
+            shard.connected.notify_all()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if 'ack' in message:
+                    item = shard.unacked.pop(message['ack'], None)
+                    if item is not None and not item[1].done():
+                        item[1].set_result(None)
+                    self._acked.set()
+                elif 'invalidate' in message:
+                    for other in self._shards:
+                        if other is not shard and other.writer is not None and not other.writer.is_closing():
+                            other.writer.write(_encode(message))
+        except (ConnectionError, ValueError) as e:
+            # При перезапуске и остановке воркер закрывает соединение, не дочитав сокет
+            if not shard.restart_requested and not self._closing:
+                logging.warning(f"Ошибка соединения с воркером {shard.index}: {e}")
+        finally:
+            if shard.writer is writer:
+                shard.writer = None
+            writer.close()
+
+    def send(self, update):
+        """Передача обновления (dict из JSON Bot API) его воркеру. Возвращает future, который
+        завершится, когда воркер обработает обновление."""
+        update_id = update['update_id']
+        user_id = _update_user_id(update)
+        shard = self._shards[shard_for(user_id, self.workers) if user_id is not None else update_id % self.workers]
+        item = shard.unacked.get(update_id)
+        if item is None:
+            # Повтор вебхука (Telegram не дождался ответа) не дублируется
+            item = shard.unacked[update_id] = (_encode({'update': update}), asyncio.get_running_loop().create_future())
+            if shard.writer is not None and not shard.writer.is_closing():
+                shard.writer.write(item[0])
+        return item[1]
+
+    async def dispatch(self, update):
+        """Передача обновления воркеру с ожиданием обработки."""
+        await asyncio.shield(self.send(update))
+
+    async def handle_webhook(self, request):
+        """Вебхук: Telegram получает ответ 200, когда воркер обработал обновление (как и в одном процессе)."""
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await self.dispatch(update)
+        return web.Response()
+
+    async def poll(self, bot: Bot, skip_updates=False, timeout=20):
+        """Long polling: обновления раздаются воркерам, не дожидаясь обработки.
+
+        skip_updates — пропустить обновления, накопившиеся до запуска (как в executor.start_polling).
+        Пока воркеры не подтвердили CLUSTER_MAX_UNACKED обновлений (медленная обработка, упавший воркер),
+        новые не запрашиваются: они ждут у Telegram, а не в памяти приёмника.
+        """
+        offset = None if skip_updates else 0
+        while True:
+            while sum(len(shard.unacked) for shard in self._shards) >= CLUSTER_MAX_UNACKED:
+                self._acked.clear()
+                await self._acked.wait()
+            payload = {'offset': offset, 'timeout': timeout} if offset is not None else {'offset': -1}
+            try:
+                updates = await bot.request('getUpdates', payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+            if offset is None:
+                offset = updates[-1]['update_id'] + 1 if updates else 0
+                continue
+            for update in updates:
+                offset = update['update_id'] + 1
+                self.send(update)
+
+    def _request_restart(self):
+        if self._restart_task is None or self._restart_task.done():
+            self._restart_task = asyncio.create_task(self.restart_workers())
+
+    async def restart_workers(self):
+        """Поочерёдный перезапуск воркеров (например, после обновления кода) без потери обновлений.
+
+        Воркер по SIGTERM дообрабатывает уже принятые обновления; остальные обновления его
+        пользователей ждут у приёмника и достаются новому процессу. Следующий воркер
+        перезапускается, когда предыдущий подключился.
+        """
+        for shard in self._shards:
+            if self._closing:
+                return
+            if shard.process is None or shard.process.returncode is not None:
+                continue
+            generation = shard.generation
+            shard.restart_requested = True
+            shard.process.terminate()
+            async with shard.connected:
+                await shard.connected.wait_for(lambda: shard.generation > generation or self._closing)
+            logging.info(f"Воркер {shard.index} перезапущен")
+
+    async def close(self, timeout=SCHEDULER_SHUTDOWN_TIMEOUT):
+        """Остановка воркеров (каждый дообрабатывает принятые обновления не дольше timeout) и закрытие сокета."""
+        self._closing = True
+        for shard in self._shards:
+            if shard.process is not None and shard.process.returncode is None:
+                shard.process.terminate()
+        # Запас сверх timeout — на остановку фоновых задач и закрытие базы в воркере
+        done, pending = await asyncio.wait(self._supervisors, timeout=timeout + 10)
+        if pending:
+            for shard in self._shards:
+                if shard.process is not None and shard.process.returncode is None:
+                    logging.warning(f"Воркер {shard.index} не остановился за {timeout + 10} с, принудительное завершение")
+                    shard.process.kill()
+            await asyncio.gather(*pending, return_exceptions=True)
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        for shard in self._shards:
+            async with shard.connected:
+                shard.connected.notify_all()
+        self._server.close()
+        await self._server.wait_closed()
+        unacked = sum(len(shard.unacked) for shard in self._shards)
+        if unacked:
+            logging.warning(f"Приёмник остановлен, не обработано обновлений: {unacked}")
+        for shard in self._shards:
+            for _, future in shard.unacked.values():
+                future.cancel()
+            shard.unacked.clear()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+async def serve_worker(dp: Dispatcher, index, socket_path, on_startup=None, on_shutdown=None):
+    """Работа процесса-воркера: обновления от приёмника обрабатываются диспетчером dp и подтверждаются.
+
+    По SIGTERM (или когда приёмник закрыл соединение) воркер перестаёт читать сокет,
+    дообрабатывает принятые обновления в on_shutdown (dp.scheduler.close) и подтверждает их;
+    неподтверждённые приёмник отправит новому процессу.
+    """
+    global _front_writer
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+    Dispatcher.set_current(dp)
+    Bot.set_current(dp.bot)
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    if on_startup is not None:
+        await on_startup(dp)
+    # Приёмник начинает отправлять обновления после этого сообщения
+    writer.write(_encode({'worker': index, 'pid': os.getpid()}))
+    _front_writer = writer
+    tasks = set()  # Обработка обновлений
+    invalidations = set()  # Сброс кэшей по событиям других воркеров
+
+    async def process(update):
+        try:
+            await dp.process_update(types.Update(**update))
+        except asyncio.CancelledError:
+            raise  # Не обработано до остановки: не подтверждаем, приёмник отправит его заново
+        except Exception as e:
+            logging.error(f"Ошибка обработки обновления {update['update_id']}: {e}")
+        if not writer.is_closing():
+            writer.write(_encode({'ack': update['update_id']}))
+
+    while True:
+        read = asyncio.ensure_future(reader.readline())
+        await asyncio.wait({read, stop}, return_when=asyncio.FIRST_COMPLETED)
+        if not read.done():
+            read.cancel()
+            break
+        try:
+            line = read.result()
+        except ConnectionError:
+            break
+        if not line:
+            break
+        message = json.loads(line)
+        # Задачи стартуют в порядке создания, так что планировщик получает обновления в порядке приёмника
+        if 'update' in message:
+            task = asyncio.ensure_future(process(message['update']))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        else:
+            task = asyncio.ensure_future(_apply_invalidation(message['invalidate'], message.get('data')))
+            invalidations.add(task)
+            task.add_done_callback(invalidations.discard)
+
+    # Сброс кэшей читает базу, поэтому завершается до on_shutdown (там закрывается база)
+    await asyncio.gather(*invalidations, return_exceptions=True)
+    if on_shutdown is not None:
+        await on_shutdown(dp)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _front_writer = None
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
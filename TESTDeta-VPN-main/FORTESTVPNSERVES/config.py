@@ -2,3 +2,61 @@ API_TOKEN = '8134098990:AAHcl7ROK5f_579KBBfhdxd7nkRteoGidqU'
 SUPPORT_USERNAME = '@SHW_manager2'
 ##AGREEMENT_TEXT = "По нажатию \"я согласен\", вы даёте согласие на аналитику пользования вами впн-сервиса, для дальнейшего составления статистики и улучшения сервиса. Мы используем информацию о ваших пользовательских данных исключительно в своих целях, не предоставляем на продажу и не занимаемся открытым распространением в соответствии с Федеральным законом № 152-ФЗ «О персональных данных»"
 ADMIN_IDS = [7940238902]
+
+# Адрес Bot API (None — официальный сервер). Можно указать локальный/тестовый сервер, например 'http://127.0.0.1:8081'
+TELEGRAM_API_SERVER = None
+
+# Режим получения обновлений: 'polling' (long polling) или 'webhook'
+RUN_MODE = 'polling'
+WEBHOOK_HOST = 'https://example.com'  # Публичный адрес, по которому Telegram достучится до бота
+WEBHOOK_PATH = '/webhook'
+WEBAPP_HOST = '127.0.0.1'  # Где слушает локальный aiohttp-сервер (за reverse proxy)
+WEBAPP_PORT = 8080
+WEBHOOK_SECRET = None  # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token (None — сгенерировать при старте)
+WEBHOOK_SHUTDOWN_TIMEOUT = 60  # Сколько секунд ждать завершения обрабатываемых обновлений при остановке
+WEBHOOK_MAX_CONNECTIONS = 40  # Одновременных запросов Telegram на вебхук (1–100)
+
+# Несколько процессов: приёмник обновлений раздаёт их воркерам по хэшу user_id (python RAB.py)
+# Воркеры дают выигрыш только на нескольких ядрах: приёмник и пересылка по сокету добавляют процессорное
+# время на обновление, и на одном ядре бот с воркерами медленнее (замер — loadtest.py --workers N).
+# Обычно WORKERS — не больше числа ядер минус одно (ядро приёмнику)
+WORKERS = 1  # Процессов-обработчиков (1 — бот работает одним процессом, без приёмника)
+CLUSTER_SOCKET_PATH = 'bot.sock'  # Unix-сокет между приёмником и воркерами
+WORKER_RESTART_DELAY = 1  # Пауза перед перезапуском упавшего воркера, секунд
+CLUSTER_MAX_UNACKED = 10000  # При стольких неподтверждённых воркерами обновлениях приёмник не вызывает getUpdates
+
+# Метрики в формате Prometheus (None — не запускать HTTP-сервер); при WORKERS > 1 воркер N
+# отдаёт метрики на порту METRICS_PORT + 1 + N, приёмник — на METRICS_PORT
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9090
+
+# Планировщик обновлений: воркеры по полосам (обновления одного чата всегда обрабатываются по порядку)
+SCHEDULER_USER_WORKERS = 32  # Одновременно обрабатываемых чатов пользователей
+SCHEDULER_ADMIN_WORKERS = 2  # Отдельные воркеры для админов (выгрузка, рассылки не занимают пользовательские)
+SCHEDULER_SHUTDOWN_TIMEOUT = 30  # Сколько секунд дообрабатывать очередь при остановке
+
+# Антифлуд: (токенов в секунду, ёмкость ведра) на пользователя для каждой callback_data;
+# 'message' — сообщения и команды, 'default' — остальные кнопки. Админы не ограничиваются
+THROTTLE_LIMITS = {
+    'get_config': (0.2, 3),
+    'plus': (0.5, 3),
+    'future_plans': (0.5, 3),
+    'message': (1, 5),
+    'default': (1, 5),
+}
+THROTTLE_EDIT_CALLBACKS = ('plus', 'future_plans')  # Кнопки, которые редактируют главное меню
+
+# Админ-панель
+USERS_PAGE_SIZE = 10  # Пользователей на странице списка
+
+# Рассылка
+BROADCAST_RATE = 28  # Сообщений в секунду (лимит Telegram ~30/с)
+BROADCAST_BURST = 1  # Ёмкость ведра токенов
+BROADCAST_CONCURRENCY = 20  # Одновременных запросов к Bot API
+BROADCAST_MAX_RETRIES = 5  # Повторов одного сообщения после RetryAfter
+BROADCAST_PROGRESS_INTERVAL = 5  # Период обновления прогресса у админа, секунд
+BROADCAST_BATCH_SIZE = 500  # Получателей, выбираемых из БД за раз (после порции сдвигается курсор)
+BROADCAST_FLUSH_SIZE = 50  # Результатов доставки в одной записи в БД
+
+# Выгрузка БД
+EXPORT_GZIP = False  # Сжимать выгрузку пользователей в .csv.gz
@@ -0,0 +1,46 @@
+import json
+import secrets
+import uuid
+
+# Подстановки в шаблоне конфига (текст конфига в таблице config). Шаблон без подстановок —
+# общий конфиг для всех, тогда персональные конфиги не генерируются
+CONFIG_PLACEHOLDERS = {
+    '{uuid}': lambda: str(uuid.uuid4()),  # id клиента VLESS/VMess
+    '{short_id}': lambda: secrets.token_hex(8),  # shortId для REALITY
+}
+
+def is_per_user_template(template):
+    """True, если по шаблону генерируются разные конфиги для каждого пользователя."""
+    return bool(template) and any(placeholder in template for placeholder in CONFIG_PLACEHOLDERS)
+
+def render_config(template):
+    """Персональный конфиг по шаблону: каждая подстановка получает новое случайное значение."""
+    config_text = template
+    for placeholder, generate in CONFIG_PLACEHOLDERS.items():
+        if placeholder in config_text:
+            config_text = config_text.replace(placeholder, generate())
+    return config_text
+
+def parse_config_file(data: bytes, filename=''):
+    """Конфиги из файла для загрузки в пул.
+
+    .json — массив строк или объектов (объекты сохраняются компактным JSON),
+    иначе — по одному конфигу на строку; пустые строки и строки с # пропускаются.
+    Повторы внутри файла отбрасываются. ValueError, если файл не разобран.
+    """
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError("файл должен быть в кодировке UTF-8")
+    if filename.lower().endswith('.json'):
+        try:
+            items = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"некорректный JSON: {e}")
+        if not isinstance(items, list):
+            raise ValueError("ожидается JSON-массив конфигов")
+        configs = [item if isinstance(item, str) else json.dumps(item, ensure_ascii=False, separators=(',', ':'))
+                   for item in items]
+    else:
+        configs = [line.strip() for line in text.splitlines()]
+    return list(dict.fromkeys(config for config in configs if config and not config.startswith('#')))
@@ -1,180 +1,1092 @@
 import sqlite3
 import logging
-import random
+import asyncio
+import functools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from metrics import observe, inc, register_gauge
+from cluster import on_invalidate
+from identifiers import format_internal_id, INTERNAL_ID_PREFIX, INTERNAL_ID_SPACE
+from migrations import migrate
+from config_pool import is_per_user_template, render_config
 
 DATABASE_PATH = 'users.db'
 DEFAULT_CONFIG_TEXT = "Default VPN configuration"
+DB_POOL_SIZE = 4  # Количество потоков (и долгоживущих соединений) в пуле
+DB_TIMEOUT = 30  # Сколько секунд ждать снятия блокировки SQLite
+DB_STATEMENT_CACHE = 128  # Размер кэша подготовленных выражений на соединение
+DB_JOURNAL_MODE = 'WAL'  # Режим журнала SQLite (WAL — читатели и писатель не блокируют друг друга)
+DB_SYNCHRONOUS = 'NORMAL'  # В режиме WAL NORMAL не теряет целостность, fsync только при checkpoint
+DB_MMAP_SIZE = 256 * 1024 * 1024  # Сколько байт файла базы читать через mmap
+DB_CACHE_SIZE = 64 * 1024 * 1024  # Кэш страниц на соединение, байт
+USER_CACHE_SIZE = 200_000  # Сколько пар user_id -> internal_id держать в памяти (LRU)
+USER_CONFIG_CACHE_SIZE = 20_000  # Сколько конфигов пользователей держать в памяти (LRU)
+USER_CACHE_WARM = 50_000  # Сколько недавно зарегистрированных пользователей загрузить в кэш при старте
+REGISTRATION_BATCH_SIZE = 200  # Максимум регистраций в одной транзакции
+REGISTRATION_BATCH_DELAY = 0.005  # Сколько секунд копить регистрации перед коммитом
+CONFIG_RECHECK_INTERVAL = 2  # Как часто (секунд) проверять, не изменил ли конфиг другой процесс
+CONFIG_POOL_SIZE = 5000  # До скольки персональных конфигов дозаполнять пул
+CONFIG_POOL_LOW_WATER = 1000  # Ниже этого числа пул начинает пополняться
+CONFIG_POOL_REFILL_BATCH = 500  # Конфигов, генерируемых в одной транзакции
+CONFIG_POOL_CHECK_INTERVAL = 30  # Период проверки размера пула, секунд
+
+_executor = None
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_config_snapshot = None  # (config_text, version) — кэш конфига
+_config_checked_at = 0.0
+_config_lock = threading.Lock()
+_pending_registrations = {}  # user_id -> (username, future)
+_registration_event = None
+_registration_batch_full = None
+_registration_writer = None
+_registration_busy = False
+# Кэш user_id -> internal_id. Обычный dict хранит порядок вставки и служит LRU;
+# ID вида VPN-<число> хранятся как int, чтобы не держать отдельную строку на каждого пользователя
+_user_cache = {}
+_user_cache_stats = {"hits": 0, "misses": 0}
+# Кэш user_id -> персональный конфиг (False — персонального нет, действует общий).
+# Выданный конфиг не меняется, поэтому запись обновляется только при выдаче из пула
+_user_configs = {}
+# user_id пользователей со статусом 'blocked': повторный /start остальных не обращается к базе
+_blocked_users = set()
+_config_pool_size = 0  # Приблизительный размер пула (уточняется при каждом пополнении)
+_config_pool_event = None
+_config_pool_refiller = None
+_config_pool_loop = None
+
+def get_connection():
+    """Долгоживущее соединение текущего потока пула (создаётся при первом обращении)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_PATH, timeout=DB_TIMEOUT, check_same_thread=False,
+                               cached_statements=DB_STATEMENT_CACHE)
+        _configure_connection(conn)
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+    return _executor
+
+def db_task(func):
+    """Превращает синхронную функцию работы с БД в корутину, выполняемую в пуле потоков.
+
+    Синхронный вариант остаётся доступен как ``func.sync`` для вызовов из других функций пула.
+    Время выполнения каждого вызова попадает в метрику db_query_seconds.
+    """
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            observe("db_query_seconds", func.__name__, time.perf_counter() - started)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), functools.partial(timed, *args, **kwargs))
+    wrapper.sync = func
+    return wrapper
+
+def _rollback():
+    """Откат незавершённой транзакции на соединении текущего потока после ошибки."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+def close_db():
+    """Остановка пула потоков и закрытие всех соединений."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    with _connections_lock:
+        if _connections:
+            try:
+                # Обновление статистики планировщика запросов для таблиц, где она устарела
+                _connections[0].execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка PRAGMA optimize: {e}")
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+
+def _configure_connection(conn):
+    """Настройки соединения: они не сохраняются в файле базы и задаются при каждом подключении."""
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE // 1024}")  # Отрицательное значение — в КиБ
 
 def init_db():
-    """Инициализация базы данных: создание таблиц users и config."""
-    try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        # Таблица пользователей
-        c.execute('''CREATE TABLE IF NOT EXISTS users 
-                    (user_id INTEGER PRIMARY KEY, 
-                     username TEXT, 
-                     internal_id TEXT UNIQUE, 
-                     registration_date DATETIME)''')
-        # Таблица для хранения конфига
-        c.execute('''CREATE TABLE IF NOT EXISTS config 
-                    (id INTEGER PRIMARY KEY, 
-                     config_text TEXT)''')
+    """Инициализация базы данных: режим журнала, миграции схемы, загрузка кэшей."""
+    conn = None
+    try:
+        conn = sqlite3.connect(DATABASE_PATH, timeout=DB_TIMEOUT)
+        # WAL: чтение (выгрузка, статистика) не блокирует запись и наоборот; режим сохраняется в файле базы
+        journal_mode = conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}").fetchone()[0]
+        if journal_mode.lower() != DB_JOURNAL_MODE.lower():
+            logging.warning(f"Не удалось включить режим журнала {DB_JOURNAL_MODE}, используется {journal_mode}")
+        _configure_connection(conn)
+        version = migrate(conn)
+        logging.info(f"Версия схемы базы данных: {version}")
+        c = conn.cursor()
         # Проверяем, есть ли конфиг в базе
-        c.execute("SELECT config_text FROM config WHERE id = 1")
-        if not c.fetchone():
-            c.execute("INSERT INTO config (id, config_text) VALUES (?, ?)", (1, DEFAULT_CONFIG_TEXT))
-        # Обратная совместимость: добавляем registration_date, если отсутствует
-        c.execute("PRAGMA table_info(users)")
-        columns = [info[1] for info in c.fetchall()]
-        if 'registration_date' not in columns:
-            c.execute("ALTER TABLE users ADD COLUMN registration_date DATETIME")
-            c.execute("UPDATE users SET registration_date = ?", (datetime.now(),))
+        c.execute("INSERT OR IGNORE INTO config (id, config_text, version) VALUES (?, ?, ?)", (1, DEFAULT_CONFIG_TEXT, 1))
         conn.commit()
+        # Загружаем конфиг в кэш
+        c.execute("SELECT config_text, version FROM config WHERE id = 1")
+        _set_config_snapshot(c.fetchone())
+        _load_config_pool_size(c)
+        # Прогреваем кэш internal_id недавно зарегистрированными пользователями
+        c.execute("SELECT user_id, internal_id FROM users ORDER BY registration_date DESC LIMIT ?",
+                 (min(USER_CACHE_WARM, USER_CACHE_SIZE),))
+        for user_id, internal_id in reversed(c.fetchall()):
+            _cache_user(user_id, internal_id)
+        _load_blocked_users(c)
     except sqlite3.Error as e:
         logging.error(f"Ошибка инициализации базы данных: {e}")
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
+
+def _set_config_snapshot(row):
+    """Атомарная замена кэша конфига (более старая версия не перезаписывает более новую)."""
+    global _config_snapshot, _config_checked_at
+    with _config_lock:
+        if row and (_config_snapshot is None or row[1] >= _config_snapshot[1]):
+            _config_snapshot = (row[0], row[1])
+        _config_checked_at = time.monotonic()
+
+def _config_is_stale():
+    return _config_snapshot is None or time.monotonic() - _config_checked_at >= CONFIG_RECHECK_INTERVAL
+
+def get_config_snapshot():
+    """Кэшированный конфиг в виде (config_text, version) без обращения к базе. None, если не загружен."""
+    return _config_snapshot
 
-def get_current_config():
-    """Получение текущего конфига из базы данных."""
+@db_task
+def refresh_config():
+    """Перечитывание конфига, если база менялась другим соединением (по PRAGMA data_version)."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_connection()
         c = conn.cursor()
-        c.execute("SELECT config_text FROM config WHERE id = 1")
-        result = c.fetchone()
-        conn.close()
-        return result[0] if result else None
+        c.execute("PRAGMA data_version")
+        data_version = c.fetchone()[0]
+        if _config_snapshot is not None and getattr(_local, 'data_version', None) == data_version:
+            # Другие соединения базу не меняли — только отмечаем время проверки
+            _set_config_snapshot(None)
+            return
+        c.execute("SELECT config_text, version FROM config WHERE id = 1")
+        _set_config_snapshot(c.fetchone())
+        _local.data_version = data_version
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка получения конфига из базы: {e}")
+
+@db_task
+def reload_config():
+    """Перечитывание конфига и размера пула без ожидания CONFIG_RECHECK_INTERVAL
+    (событие 'config': их изменил другой процесс)."""
+    try:
+        c = get_connection().cursor()
+        c.execute("SELECT config_text, version FROM config WHERE id = 1")
+        _set_config_snapshot(c.fetchone())
+        _load_config_pool_size(c)
     except sqlite3.Error as e:
         logging.error(f"Ошибка получения конфига из базы: {e}")
+
+on_invalidate("config", reload_config)
+
+async def get_current_config():
+    """Получение текущего конфига (из кэша; база проверяется не чаще CONFIG_RECHECK_INTERVAL)."""
+    if _config_is_stale():
+        await refresh_config()
+    return _config_snapshot[0] if _config_snapshot else None
+
+def _allocate_internal_id(c):
+    """Выдача следующего internal_id в текущей транзакции: O(1), без случайных проб.
+
+    Номер берётся из счётчика id_sequence и переставляется сетью Фейстеля
+    (identifiers.permute), поэтому ID уникальны и при параллельных регистрациях.
+    Занятые ID (например, импортированные вручную) пропускаются.
+    """
+    while True:
+        c.execute("UPDATE id_sequence SET next_value = next_value + 1 WHERE name = 'internal_id' "
+                  "RETURNING next_value - 1, seed")
+        n, seed = c.fetchone()
+        if n >= INTERNAL_ID_SPACE:
+            raise sqlite3.DatabaseError("Пространство internal_id исчерпано, увеличьте INTERNAL_ID_SPACE")
+        internal_id = format_internal_id(n, seed)
+        c.execute("SELECT 1 FROM users WHERE internal_id = ?", (internal_id,))
+        if not c.fetchone():
+            return internal_id
+
+def _allocate_internal_ids(c, count):
+    """Выдача сразу count новых internal_id одним обновлением счётчика."""
+    c.execute("UPDATE id_sequence SET next_value = next_value + ? WHERE name = 'internal_id' "
+              "RETURNING next_value - ?, seed", (count, count))
+    first, seed = c.fetchone()
+    if first + count > INTERNAL_ID_SPACE:
+        raise sqlite3.DatabaseError("Пространство internal_id исчерпано, увеличьте INTERNAL_ID_SPACE")
+    internal_ids = []
+    for n in range(first, first + count):
+        internal_id = format_internal_id(n, seed)
+        c.execute("SELECT 1 FROM users WHERE internal_id = ?", (internal_id,))
+        internal_ids.append(_allocate_internal_id(c) if c.fetchone() else internal_id)
+    return internal_ids
+
+def _add_daily_registrations(c, day, count):
+    """Инкрементальное обновление ежедневной сводки регистраций."""
+    c.execute('''INSERT INTO user_daily_stats (day, registrations) VALUES (?, ?)
+                 ON CONFLICT(day) DO UPDATE SET registrations = registrations + excluded.registrations''',
+             (day, count))
+
+def _add_status_counts(c, counts):
+    """Инкрементальное обновление счётчиков пользователей по статусам (counts — статус -> изменение)."""
+    c.executemany('''INSERT INTO user_status_counts (status, users) VALUES (?, ?)
+                     ON CONFLICT(status) DO UPDATE SET users = users + excluded.users''',
+                  [(status, count) for status, count in counts.items() if count])
+
+def _claim_configs(c, count):
+    """Выдача count персональных конфигов в текущей транзакции.
+
+    Конфиги берутся из пула одним DELETE ... RETURNING по первичному ключу. Если пул пуст,
+    недостающие генерируются по шаблону на месте; при общем шаблоне вместо них возвращается None.
+    """
+    global _config_pool_size
+    c.execute("DELETE FROM config_pool WHERE id IN (SELECT id FROM config_pool ORDER BY id LIMIT ?) "
+              "RETURNING config_text", (count,))
+    configs = [row[0] for row in c.fetchall()]
+    _config_pool_size = max(_config_pool_size - len(configs), 0)
+    missing = count - len(configs)
+    if missing:
+        c.execute("SELECT config_text FROM config WHERE id = 1")
+        row = c.fetchone()
+        template = row[0] if row else None
+        if is_per_user_template(template):
+            inc("config_pool_misses", "registration", missing)
+            configs += [render_config(template) for _ in range(missing)]
+        else:
+            configs += [None] * missing
+    return configs
+
+def _load_config_pool_size(c):
+    """Точный размер пула (конфиги из него выдают и другие процессы)."""
+    global _config_pool_size
+    c.execute("SELECT COUNT(*) FROM config_pool")
+    _config_pool_size = c.fetchone()[0]
+    return _config_pool_size
+
+@db_task
+def count_config_pool():
+    """Размер пула конфигов или None при ошибке."""
+    try:
+        return _load_config_pool_size(get_connection().cursor())
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка подсчёта конфигов в пуле: {e}")
         return None
 
-def generate_config():
-    """Генерация уникального internal_id и получение текущего конфига."""
-    internal_id = f"VPN-{random.randint(100, 999)}"
+@db_task
+def refill_config_pool(target, batch):
+    """Генерация до batch персональных конфигов по текущему шаблону, пока в пуле меньше target.
+
+    Возвращает размер пула после пополнения или None при ошибке.
+    """
+    global _config_pool_size
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_connection()
         c = conn.cursor()
-        while True:
-            c.execute("SELECT internal_id FROM users WHERE internal_id = ?", (internal_id,))
-            if not c.fetchone():
-                break
-            internal_id = f"VPN-{random.randint(100, 999)}"
-        conn.close()
-        config_text = get_current_config()
-        if config_text is None:
-            return None, None
-        return internal_id, config_text
+        c.execute("SELECT config_text FROM config WHERE id = 1")
+        row = c.fetchone()
+        c.execute("SELECT COUNT(*) FROM config_pool")
+        size = c.fetchone()[0]
+        template = row[0] if row else None
+        if is_per_user_template(template) and size < target:
+            now = datetime.now()
+            c.executemany("INSERT OR IGNORE INTO config_pool (config_text, source, created_at) VALUES (?, 'generated', ?)",
+                          [(render_config(template), now) for _ in range(min(batch, target - size))])
+            size += c.rowcount
+            conn.commit()
+        _config_pool_size = size
+        return size
     except sqlite3.Error as e:
-        logging.error(f"Ошибка генерации internal_id: {e}")
-        return None, None
+        logging.error(f"Ошибка пополнения пула конфигов: {e}")
+        _rollback()
+        return None
 
-def register_user(user_id, username):
-    """Регистрация нового пользователя в базе данных."""
+@db_task
+def add_pool_configs(configs):
+    """Загрузка готовых конфигов в пул (например, из файла админа). Возвращает число добавленных или None.
+
+    Конфиги, уже лежащие в пуле, пропускаются.
+    """
+    global _config_pool_size
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_connection()
         c = conn.cursor()
-        internal_id, config = generate_config()
-        if internal_id is None or config is None:
-            return None, None
-        c.execute("INSERT INTO users (user_id, username, internal_id, registration_date) VALUES (?, ?, ?, ?)",
-                 (user_id, username, internal_id, datetime.now()))
+        now = datetime.now()
+        c.executemany("INSERT OR IGNORE INTO config_pool (config_text, source, created_at) VALUES (?, 'import', ?)",
+                      [(config_text, now) for config_text in configs])
+        added = c.rowcount
         conn.commit()
-        conn.close()
-        return internal_id, config
+        _config_pool_size += added
+        return added
     except sqlite3.Error as e:
-        logging.error(f"Ошибка регистрации пользователя: {e}")
+        logging.error(f"Ошибка загрузки конфигов в пул: {e}")
+        _rollback()
+        return None
+
+async def _run_config_pool_refill():
+    """Фоновое пополнение пула: при запуске и когда конфигов меньше CONFIG_POOL_LOW_WATER
+    пул дозаполняется до CONFIG_POOL_SIZE порциями по CONFIG_POOL_REFILL_BATCH."""
+    refill = True
+    while True:
+        while refill:
+            before = _config_pool_size
+            size = await refill_config_pool(CONFIG_POOL_SIZE, CONFIG_POOL_REFILL_BATCH)
+            refill = size is not None and before < size < CONFIG_POOL_SIZE
+        # asyncio.wait, а не wait_for: wait_for (до Python 3.12) теряет отмену задачи,
+        # если событие выставлено в тот же момент, и остановка бота зависала бы
+        waiter = asyncio.ensure_future(_config_pool_event.wait())
+        try:
+            await asyncio.wait({waiter}, timeout=CONFIG_POOL_CHECK_INTERVAL)
+        finally:
+            waiter.cancel()
+        _config_pool_event.clear()
+        size = await count_config_pool()
+        refill = size is not None and size < CONFIG_POOL_LOW_WATER
+
+def start_config_pool_refill():
+    """Запуск фонового пополнения пула конфигов."""
+    global _config_pool_event, _config_pool_refiller, _config_pool_loop
+    if _config_pool_refiller is None or _config_pool_refiller.done():
+        _config_pool_event = asyncio.Event()
+        _config_pool_loop = asyncio.get_running_loop()
+        _config_pool_refiller = asyncio.create_task(_run_config_pool_refill())
+
+def _wake_config_pool_refill():
+    """Внеочередная проверка пула (можно вызывать из потока пула соединений)."""
+    if _config_pool_event is not None and _config_pool_loop is not None and not _config_pool_loop.is_closed():
+        _config_pool_loop.call_soon_threadsafe(_config_pool_event.set)
+
+async def stop_config_pool_refill():
+    """Остановка фонового пополнения пула конфигов."""
+    global _config_pool_refiller
+    if _config_pool_refiller is not None:
+        _config_pool_refiller.cancel()
+        await asyncio.gather(_config_pool_refiller, return_exceptions=True)
+        _config_pool_refiller = None
+
+register_gauge("config_pool", lambda: {"size": _config_pool_size}, "Персональных конфигов в пуле")
+
+@db_task
+def register_users_batch(users):
+    """Регистрация пачки пользователей одной транзакцией (group commit).
+
+    users — список (user_id, username) без повторов user_id. Каждый новый пользователь получает
+    персональный конфиг из пула (см. _claim_configs).
+    Возвращает словарь user_id -> (internal_id, config_text); для уже зарегистрированных — их текущие данные.
+    config_text равен None, если пользователю выдаётся общий конфиг.
+    """
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        registered = {}
+        new_users = []
+        for user_id, username in users:
+            c.execute("SELECT internal_id, config_text FROM users WHERE user_id = ?", (user_id,))
+            row = c.fetchone()
+            if row:
+                registered[user_id] = row
+            else:
+                new_users.append((user_id, username))
+        if new_users:
+            now = datetime.now()
+            internal_ids = _allocate_internal_ids(c, len(new_users))
+            configs = _claim_configs(c, len(new_users))
+            rows = [(user_id, username, internal_id, now, config_text)
+                    for (user_id, username), internal_id, config_text in zip(new_users, internal_ids, configs)]
+            c.executemany("INSERT INTO users (user_id, username, internal_id, registration_date, config_text) "
+                          "VALUES (?, ?, ?, ?, ?)", rows)
+            for user_id, _, internal_id, _, config_text in rows:
+                registered[user_id] = (internal_id, config_text)
+            _add_daily_registrations(c, now.date().isoformat(), len(new_users))
+            _add_status_counts(c, {'active': len(new_users)})
+        conn.commit()
+        return registered
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка регистрации пользователей: {e}")
+        _rollback()
+        return {}
+
+async def _run_registration_writer():
+    """Единственный писатель регистраций: копит запросы и коммитит их пачками."""
+    global _registration_busy
+    while True:
+        await _registration_event.wait()
+        if len(_pending_registrations) < REGISTRATION_BATCH_SIZE:
+            try:
+                await asyncio.wait_for(_registration_batch_full.wait(), REGISTRATION_BATCH_DELAY)
+            except asyncio.TimeoutError:
+                pass
+        _registration_event.clear()
+        _registration_batch_full.clear()
+        batch = {}
+        for user_id in list(_pending_registrations)[:REGISTRATION_BATCH_SIZE]:
+            batch[user_id] = _pending_registrations.pop(user_id)
+        if _pending_registrations:
+            _registration_event.set()
+        if not batch:
+            continue
+        _registration_busy = True
+        try:
+            registered = await register_users_batch([(user_id, username) for user_id, (username, _) in batch.items()])
+            error = None
+        except Exception as e:
+            registered, error = {}, e
+        finally:
+            _registration_busy = False
+        for user_id, (_, future) in batch.items():
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(registered.get(user_id))
+        if _config_pool_size < CONFIG_POOL_LOW_WATER and _config_pool_event is not None:
+            _config_pool_event.set()
+
+async def register_user(user_id, username):
+    """Регистрация нового пользователя в базе данных.
+
+    Запрос ставится в очередь группового коммита; повторные /start одного user_id
+    в пределах пачки объединяются. Возвращает (internal_id, config), где config —
+    персональный конфиг пользователя или общий, если персональных нет.
+    """
+    global _registration_event, _registration_batch_full, _registration_writer
+    if _registration_writer is None or _registration_writer.done():
+        _registration_event = asyncio.Event()
+        _registration_batch_full = asyncio.Event()
+        _registration_writer = asyncio.create_task(_run_registration_writer())
+    pending = _pending_registrations.get(user_id)
+    if pending is None:
+        pending = (username, asyncio.get_running_loop().create_future())
+        _pending_registrations[user_id] = pending
+        _registration_event.set()
+        if len(_pending_registrations) >= REGISTRATION_BATCH_SIZE:
+            _registration_batch_full.set()
+    registered = await asyncio.shield(pending[1])
+    if registered is None:
+        return None, None
+    internal_id, config = registered
+    _cache_user(user_id, internal_id)
+    _cache_user_config(user_id, config)
+    if config is None:
+        config = await get_current_config()
+    if config is None:
         return None, None
+    return internal_id, config
 
-def get_user_internal_id(user_id):
-    """Получение internal_id пользователя по user_id."""
+async def stop_registration_writer():
+    """Дописывание накопленных регистраций и остановка писателя."""
+    global _registration_writer
+    while (_pending_registrations or _registration_busy) and _registration_writer is not None \
+            and not _registration_writer.done():
+        await asyncio.sleep(REGISTRATION_BATCH_DELAY)
+    if _registration_writer is not None:
+        _registration_writer.cancel()
+        _registration_writer = None
+
+def _cache_user(user_id, internal_id):
+    """Запись в кэш internal_id с вытеснением самого давнего пользователя."""
+    number = internal_id[len(INTERNAL_ID_PREFIX):]
+    if internal_id.startswith(INTERNAL_ID_PREFIX) and number.isdigit() and str(int(number)) == number:
+        value = int(number)
+    else:
+        value = internal_id
+    _user_cache.pop(user_id, None)
+    _user_cache[user_id] = value
+    if len(_user_cache) > USER_CACHE_SIZE:
+        del _user_cache[next(iter(_user_cache))]
+
+def _cache_user_config(user_id, config_text):
+    """Запись в кэш конфига пользователя (None — персонального конфига нет)."""
+    _user_configs.pop(user_id, None)
+    _user_configs[user_id] = config_text if config_text is not None else False
+    if len(_user_configs) > USER_CONFIG_CACHE_SIZE:
+        del _user_configs[next(iter(_user_configs))]
+
+def get_user_cache_stats():
+    """Счётчики кэша internal_id: попадания, промахи и текущий размер (и размер кэша конфигов)."""
+    return {**_user_cache_stats, "size": len(_user_cache), "configs": len(_user_configs)}
+
+register_gauge("user_cache", get_user_cache_stats, "Кэш internal_id: попадания, промахи, размер")
+
+@db_task
+def load_user_internal_id(user_id):
+    """Получение internal_id пользователя по user_id из базы данных."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_connection()
         c = conn.cursor()
         c.execute("SELECT internal_id FROM users WHERE user_id = ?", (user_id,))
         result = c.fetchone()
-        conn.close()
         return result[0] if result else None
     except sqlite3.Error as e:
         logging.error(f"Ошибка получения internal_id: {e}")
         return None
 
+async def get_user_internal_id(user_id):
+    """Получение internal_id пользователя по user_id (сначала из кэша)."""
+    value = _user_cache.pop(user_id, None)
+    if value is not None:
+        _user_cache[user_id] = value
+        _user_cache_stats["hits"] += 1
+        return f"{INTERNAL_ID_PREFIX}{value}" if isinstance(value, int) else value
+    _user_cache_stats["misses"] += 1
+    internal_id = await load_user_internal_id(user_id)
+    if internal_id is not None:
+        _cache_user(user_id, internal_id)
+    return internal_id
+
+@db_task
+def load_user_config(user_id):
+    """(internal_id, config_text) пользователя; (None, None), если он не зарегистрирован.
+
+    Пользователю без персонального конфига (зарегистрирован до появления пула) конфиг
+    выдаётся из пула при первом запросе. config_text равен None, если действует общий конфиг.
+    """
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute("SELECT internal_id, config_text FROM users WHERE user_id = ?", (user_id,))
+        row = c.fetchone()
+        if row is None:
+            return None, None
+        internal_id, config_text = row
+        if config_text is not None:
+            return internal_id, config_text
+        # Пул опустошают и другие процессы, поэтому счётчик _config_pool_size здесь не годится:
+        # транзакция записи открывается, только если пул не пуст по самой базе (или шаблон персональный)
+        if not is_per_user_template(_config_snapshot[0] if _config_snapshot else None):
+            c.execute("SELECT 1 FROM config_pool LIMIT 1")
+            if c.fetchone() is None:
+                return internal_id, None
+        config_text = _claim_configs(c, 1)[0]
+        if config_text is None:
+            # Пул успели опустошить, а шаблон общий: DELETE ничего не выдал, но открыл транзакцию
+            conn.rollback()
+            return internal_id, None
+        c.execute("UPDATE users SET config_text = ? WHERE user_id = ? AND config_text IS NULL",
+                 (config_text, user_id))
+        if c.rowcount:
+            conn.commit()
+        else:
+            # Конфиг уже выдан параллельным запросом — возвращаем взятый обратно в пул
+            conn.rollback()
+            c.execute("SELECT config_text FROM users WHERE user_id = ?", (user_id,))
+            config_text = c.fetchone()[0]
+        return internal_id, config_text
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка получения конфига пользователя: {e}")
+        _rollback()
+        return None, None
+
+async def get_user_config(user_id):
+    """Получение (internal_id, config) пользователя: персональный конфиг или общий.
+
+    Повторные запросы обслуживаются из кэша без обращения к базе; пользователь без
+    персонального конфига идёт в базу, только пока в пуле есть что выдать.
+    """
+    cached = _user_configs.pop(user_id, None)
+    if cached is not None:
+        _user_configs[user_id] = cached
+        if cached is not False or not (_config_pool_size > 0 or
+                                       is_per_user_template(_config_snapshot[0] if _config_snapshot else None)):
+            internal_id = await get_user_internal_id(user_id)
+            if internal_id is not None:
+                return internal_id, cached or await get_current_config()
+    internal_id, config_text = await load_user_config(user_id)
+    if internal_id is None:
+        return None, None
+    _cache_user(user_id, internal_id)
+    _cache_user_config(user_id, config_text)
+    if config_text is None:
+        config_text = await get_current_config()
+    return internal_id, config_text
+
+@db_task
 def update_config(new_config):
-    """Обновление конфига в базе данных."""
+    """Обновление конфига (шаблона персональных конфигов) в базе данных.
+
+    Сгенерированные по старому шаблону конфиги удаляются из пула, загруженные админом остаются.
+    Уже выданные пользователям персональные конфиги не меняются.
+    """
+    global _config_pool_size
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_connection()
         c = conn.cursor()
-        c.execute("DELETE FROM config WHERE id = 1")
-        c.execute("INSERT INTO config (id, config_text) VALUES (?, ?)", (1, new_config))
+        c.execute("UPDATE config SET config_text = ?, version = version + 1 WHERE id = 1", (new_config,))
+        if c.rowcount == 0:
+            c.execute("INSERT INTO config (id, config_text, version) VALUES (?, ?, ?)", (1, new_config, 1))
+        c.execute("SELECT config_text, version FROM config WHERE id = 1")
+        row = c.fetchone()
+        c.execute("DELETE FROM config_pool WHERE source = 'generated'")
+        c.execute("SELECT COUNT(*) FROM config_pool")
+        pool_size = c.fetchone()[0]
         conn.commit()
-        conn.close()
+        _set_config_snapshot(row)
+        _config_pool_size = pool_size
+        _wake_config_pool_refill()
         return True
     except sqlite3.Error as e:
         logging.error(f"Ошибка обновления конфига в базе: {e}")
+        _rollback()
         return False
 
+@db_task
 def get_user_stats():
-    """Получение статистики пользователей."""
+    """Получение статистики пользователей.
+
+    Общее число берётся из ежедневных сводок, число по статусам — из счётчиков user_status_counts,
+    окна — одним запросом по индексу registration_date (читаются только записи за последние 30 дней).
+    """
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_connection()
         c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM users")
+        now = datetime.now()
+        c.execute("SELECT COALESCE(SUM(registrations), 0) FROM user_daily_stats")
         total_users = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM users WHERE registration_date >= ?",
-                 (datetime.now() - timedelta(hours=24),))
-        users_24h = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM users WHERE registration_date >= ?",
-                 (datetime.now() - timedelta(days=3),))
-        users_3d = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM users WHERE registration_date >= ?",
-                 (datetime.now() - timedelta(days=7),))
-        users_7d = c.fetchone()[0]
-        c.execute("SELECT COUNT(*) FROM users WHERE registration_date >= ?",
-                 (datetime.now() - timedelta(days=30),))
-        users_30d = c.fetchone()[0]
-        conn.close()
+        c.execute('''SELECT COUNT(*),
+                            COALESCE(SUM(registration_date >= ?), 0),
+                            COALESCE(SUM(registration_date >= ?), 0),
+                            COALESCE(SUM(registration_date >= ?), 0)
+                     FROM users WHERE registration_date >= ?''',
+                 (now - timedelta(hours=24), now - timedelta(days=3), now - timedelta(days=7),
+                  now - timedelta(days=30)))
+        users_30d, users_24h, users_3d, users_7d = c.fetchone()
+        c.execute("SELECT status, users FROM user_status_counts")
+        by_status = dict(c.fetchall())
+        c.execute("SELECT COUNT(*) FROM config_pool")
+        config_pool = c.fetchone()[0]
         return {
             "total": total_users,
+            "active": by_status.get('active', 0),
+            "blocked": by_status.get('blocked', 0),
             "24h": users_24h,
             "3d": users_3d,
             "7d": users_7d,
-            "30d": users_30d
+            "30d": users_30d,
+            "config_pool": config_pool
         }
     except sqlite3.Error as e:
         logging.error(f"Ошибка получения статистики пользователей: {e}")
         return None
 
-def get_all_user_ids():
-    """Получение всех user_id из базы данных."""
+@db_task
+def get_daily_registrations(days):
+    """Число регистраций по дням за последние days дней (из сводок), от новых к старым."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_connection()
         c = conn.cursor()
-        c.execute("SELECT user_id FROM users")
-        users = [row[0] for row in c.fetchall()]
-        conn.close()
-        return users
+        today = datetime.now().date()
+        first_day = today - timedelta(days=days - 1)
+        c.execute("SELECT day, registrations FROM user_daily_stats WHERE day >= ?", (first_day.isoformat(),))
+        counts = dict(c.fetchall())
+        return [
+            ((today - timedelta(days=i)).isoformat(), counts.get((today - timedelta(days=i)).isoformat(), 0))
+            for i in range(days)
+        ]
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка получения статистики по дням: {e}")
+        return None
+
+# Порядки списка пользователей в админ-панели: ключ сортировки (None — только user_id) и по убыванию ли.
+# Индекс по ключу хранит и rowid (= user_id), поэтому пара (ключ, user_id) берётся из одного индекса.
+# NULL (импорт без username или даты) заменяется пустой строкой: с NULL сравнение курсора не выполняется
+# и такие строки пропускались бы; выражения совпадают с индексами миграции 10
+_USER_PAGE_ORDERS = {
+    'id': (None, True),  # Сначала большие TG ID
+    'date': ("COALESCE(registration_date, '')", True),  # Сначала недавно зарегистрированные
+    'name': ("COALESCE(username, '') COLLATE NOCASE", False),  # По алфавиту без учёта регистра (поиск по началу username)
+}
+_USER_PAGE_COLUMNS = "user_id, internal_id, username, registration_date, status"
+
+def _user_from_row(row):
+    return {
+        "tg_id": row[0],
+        "vpn_id": row[1],
+        "username": row[2],
+        "registered_at": row[3],
+        "status": row[4]
+    }
+
+@db_task
+def get_users_page(order, cursor=None, backward=False, prefix=None, limit=10):
+    """Страница пользователей с keyset-пагинацией: один запрос по индексу с LIMIT, без OFFSET,
+    поэтому любая страница читает не больше limit + 1 строк при любом размере таблицы.
+
+    cursor — user_id последнего пользователя предыдущей страницы (при backward=True — первого
+    пользователя следующей), None — первая страница. prefix (только для order='name') — начало
+    username без учёта регистра. Возвращает (пользователи, есть ли ещё страницы в этом направлении)
+    или (None, False) при ошибке.
+    """
+    key, descending = _USER_PAGE_ORDERS[order]
+    if backward:
+        descending = not descending
+    op, direction = ('<', 'DESC') if descending else ('>', 'ASC')
+    params = {"cursor": cursor, "limit": limit + 1}
+    bounds = []
+    if prefix:
+        # Username в Telegram — только латиница, цифры и _, для них NOCASE сравнивает без учёта регистра
+        params.update(low=prefix, high=f"{prefix}\uffff")
+        bounds = [f"{_USER_PAGE_ORDERS['name'][0]} >= :low", f"{_USER_PAGE_ORDERS['name'][0]} < :high"]
+
+    def select(conditions, order_by):
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return f"SELECT {_USER_PAGE_COLUMNS} FROM users{where} ORDER BY {order_by} LIMIT :limit"
+
+    if key is None:
+        sql = select(bounds + ([f"user_id {op} :cursor"] if cursor is not None else []), f"user_id {direction}")
+    elif cursor is None:
+        sql = select(bounds, f"{key} {direction}, user_id {direction}")
+    else:
+        # Курсор — пара (ключ, user_id). Сравнение пар SQLite не превращает в поиск по индексу, а одинаковых
+        # ключей бывает много (дата общей пачки регистраций, NoUsername), поэтому два поиска: остаток строк
+        # с ключом курсора и строки после него. Во втором нужна только дальняя граница префикса,
+        # иначе SQLite начнёт поиск с начала префикса, а не с курсора
+        cursor_key = f"(SELECT {key} FROM users WHERE user_id = :cursor)"
+        same_key = select([f"{key} = {cursor_key}", f"user_id {op} :cursor"], f"user_id {direction}")
+        far_bound = bounds[1:] if op == '>' else bounds[:1]
+        after_key = select(far_bound + [f"{key} {op} {cursor_key}"], f"{key} {direction}, user_id {direction}")
+        sql = f"SELECT * FROM ({same_key}) UNION ALL SELECT * FROM ({after_key}) LIMIT :limit"
+    try:
+        c = get_connection().cursor()
+        c.execute(sql, params)
+        rows = c.fetchall()
+        users = [_user_from_row(row) for row in rows[:limit]]
+        if backward:
+            users.reverse()
+        return users, len(rows) > limit
     except sqlite3.Error as e:
         logging.error(f"Ошибка получения списка пользователей: {e}")
+        return None, False
+
+@db_task
+def find_users(query):
+    """Пользователи с точным TG ID или VPN ID (число ищется и как TG ID, и как VPN-<число>). None при ошибке."""
+    query = query.strip()
+    internal_ids = {query, query.upper()}
+    user_id = None
+    if query.isdigit():
+        user_id = int(query)
+        internal_ids.add(f"{INTERNAL_ID_PREFIX}{query}")
+    try:
+        c = get_connection().cursor()
+        placeholders = ", ".join("?" * len(internal_ids))
+        c.execute(f"SELECT {_USER_PAGE_COLUMNS} FROM users WHERE user_id = ? OR internal_id IN ({placeholders}) "
+                  f"ORDER BY user_id", (user_id, *internal_ids))
+        return [_user_from_row(row) for row in c.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка поиска пользователя: {e}")
+        return None
+
+def iter_user_rows(chunk_size):
+    """Потоковое чтение пользователей порциями по chunk_size строк (вызывать в потоке пула).
+
+    Выдаёт списки кортежей (user_id, internal_id, username, registration_date).
+    """
+    c = get_connection().cursor()
+    c.execute("SELECT user_id, internal_id, username, registration_date FROM users ORDER BY user_id")
+    while True:
+        rows = c.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+def import_user_rows(rows):
+    """Запись порции импортируемых пользователей одной транзакцией (вызывать в потоке пула).
+
+    rows — список (номер строки, user_id, internal_id, username, registration_date).
+    Новые пользователи добавляются одним executemany, у существующих с тем же internal_id
+    обновляется username (пустой username в файле не стирает известный). Строка пропускается как конфликт, если её user_id уже зарегистрирован
+    с другим internal_id или internal_id занят другим пользователем (в том числе строкой выше в файле).
+    Возвращает (добавлено, обновлено, конфликты), конфликты — список (номер строки, описание).
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Существующие записи для всей порции ищутся двумя запросами по индексам (ключи передаются
+        # JSON-массивом), а не запросом на строку
+        c.execute("SELECT user_id, internal_id FROM users WHERE user_id IN (SELECT value FROM json_each(?))",
+                  (json.dumps([row[1] for row in rows]),))
+        by_user = dict(c.fetchall())
+        c.execute("SELECT internal_id, user_id FROM users WHERE internal_id IN (SELECT value FROM json_each(?))",
+                  (json.dumps([row[2] for row in rows]),))
+        by_internal_id = dict(c.fetchall())
+
+        inserts, updates, conflicts = [], [], []
+        days = {}
+        for line, user_id, internal_id, username, registration_date in rows:
+            current = by_user.get(user_id)
+            owner = by_internal_id.get(internal_id)
+            if current is not None:
+                if current == internal_id:
+                    if username is not None:
+                        updates.append((username, user_id, username))
+                else:
+                    conflicts.append((line, f"TG ID {user_id} уже зарегистрирован как {current}"))
+            elif owner is not None:
+                conflicts.append((line, f"{internal_id} уже выдан TG ID {owner}"))
+            else:
+                inserts.append((user_id, username, internal_id, registration_date))
+                by_user[user_id] = internal_id
+                by_internal_id[internal_id] = user_id
+                day = registration_date.date().isoformat()
+                days[day] = days.get(day, 0) + 1
+
+        c.executemany("INSERT INTO users (user_id, username, internal_id, registration_date) VALUES (?, ?, ?, ?)",
+                      inserts)
+        c.executemany("UPDATE users SET username = ? WHERE user_id = ? AND username IS NOT ?", updates)
+        updated = c.rowcount if updates else 0
+        for day, count in days.items():
+            _add_daily_registrations(c, day, count)
+        _add_status_counts(c, {'active': len(inserts)})
+        conn.commit()
+        return len(inserts), updated, conflicts
+    except Exception:
+        conn.rollback()
+        raise
+
+def _load_blocked_users(c):
+    """Загрузка user_id заблокированных пользователей в память (по индексу idx_users_status)."""
+    global _blocked_users
+    c.execute("SELECT user_id FROM users WHERE status = 'blocked'")
+    _blocked_users = {row[0] for row in c.fetchall()}
+
+def _add_blocked_users(user_ids):
+    """Пользователи, которых отметила недоступными рассылка другого воркера (без чтения базы)."""
+    _blocked_users.update(user_ids)
+
+on_invalidate("blocked", _add_blocked_users)
+
+@db_task
+def _activate_user(user_id):
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute("UPDATE users SET status = 'active', last_contact_at = ? WHERE user_id = ? AND status != 'active'",
+                 (datetime.now(), user_id))
+        changed = c.rowcount
+        if changed:
+            _add_status_counts(c, {'active': 1, 'blocked': -1})
+        conn.commit()
+        _blocked_users.discard(user_id)
+        return changed > 0
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка смены статуса пользователя: {e}")
+        _rollback()
+        return False
+
+async def reactivate_user(user_id):
+    """Возврат пользователя в статус 'active' (он снова написал боту).
 
+    Статус проверяется по множеству заблокированных в памяти: для остальных пользователей
+    обращения к базе нет.
+    """
+    if user_id not in _blocked_users:
+        return False
+    return await _activate_user(user_id)
+
+@db_task
+def create_broadcast_job(text, photo, url, admin_chat_id):
+    """Создание задания рассылки. Возвращает id задания."""
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute("SELECT users FROM user_status_counts WHERE status = 'active'")
+        row = c.fetchone()
+        total = row[0] if row else 0
+        c.execute("INSERT INTO broadcast_jobs (text, photo, url, admin_chat_id, total, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                 (text, photo, url, admin_chat_id, total, datetime.now()))
+        conn.commit()
+        return c.lastrowid
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка создания задания рассылки: {e}")
+        _rollback()
+        return None
+
+def _broadcast_job_from_row(row):
+    return {
+        "id": row[0],
+        "text": row[1],
+        "photo": row[2],
+        "url": row[3],
+        "admin_chat_id": row[4],
+        "status": row[5],
+        "cursor": row[6],
+        "total": row[7],
+        "sent": row[8],
+        "failed": row[9]
+    }
+
+@db_task
+def get_broadcast_job(job_id):
+    """Получение задания рассылки по id."""
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute("SELECT id, text, photo, url, admin_chat_id, status, cursor, total, sent, failed "
+                  "FROM broadcast_jobs WHERE id = ?", (job_id,))
+        row = c.fetchone()
+        return _broadcast_job_from_row(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка получения задания рассылки: {e}")
+        return None
+
+@db_task
+def get_unfinished_broadcast_jobs():
+    """Получение незавершённых заданий рассылки (в очереди, выполняются или на паузе)."""
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute("SELECT id, text, photo, url, admin_chat_id, status, cursor, total, sent, failed "
+                  "FROM broadcast_jobs WHERE status IN ('pending', 'running', 'paused') ORDER BY id")
+        return [_broadcast_job_from_row(row) for row in c.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка получения заданий рассылки: {e}")
         return []
 
-def get_all_users():
-    """Получение всех данных пользователей из базы данных."""
+@db_task
+def get_broadcast_recipients(job_id, cursor, limit):
+    """Следующая порция доступных получателей после курсора, которым задание ещё не доставлялось."""
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_connection()
         c = conn.cursor()
-        c.execute("SELECT user_id, internal_id, username, registration_date FROM users")
-        users = [
-            {
-                "tg_id": row[0],
-                "vpn_id": row[1],
-                "username": row[2],
-                "registered_at": row[3]
-            } for row in c.fetchall()
-        ]
-        conn.close()
-        return users
+        c.execute('''SELECT user_id FROM users
+                     WHERE status = 'active' AND user_id > ?
+                       AND NOT EXISTS (SELECT 1 FROM broadcast_deliveries d
+                                       WHERE d.job_id = ? AND d.user_id = users.user_id)
+                     ORDER BY user_id LIMIT ?''', (cursor, job_id, limit))
+        return [row[0] for row in c.fetchall()]
     except sqlite3.Error as e:
-        logging.error(f"Ошибка получения данных пользователей: {e}")
+        logging.error(f"Ошибка получения получателей рассылки: {e}")
         return None
+
+@db_task
+def save_broadcast_progress(job_id, deliveries, cursor=None):
+    """Пакетная запись результатов доставки одной транзакцией.
+
+    deliveries — список (user_id, error, unreachable), где error равен None при успешной отправке,
+    а unreachable — признак того, что пользователь больше недоступен (заблокировал бота и т.п.).
+    В той же транзакции обновляются статус, последняя ошибка и время последней доставки пользователей.
+    Если передан cursor, курсор задания сдвигается, а перекрытые им доставки удаляются.
+    """
+    sent = sum(1 for _, error, _ in deliveries if error is None)
+    failed = len(deliveries) - sent
+    now = datetime.now()
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.executemany("INSERT OR IGNORE INTO broadcast_deliveries (job_id, user_id, error) VALUES (?, ?, ?)",
+                      [(job_id, user_id, error) for user_id, error, _ in deliveries])
+        c.executemany("UPDATE users SET last_contact_at = ? WHERE user_id = ?",
+                      [(now, user_id) for user_id, error, _ in deliveries if error is None])
+        c.executemany("UPDATE users SET last_error = ? WHERE user_id = ?",
+                      [(error, user_id) for user_id, error, _ in deliveries if error is not None])
+        blocked = [user_id for user_id, _, unreachable in deliveries if unreachable]
+        c.executemany("UPDATE users SET status = 'blocked' WHERE user_id = ? AND status != 'blocked'",
+                      [(user_id,) for user_id in blocked])
+        if blocked:
+            _add_status_counts(c, {'blocked': c.rowcount, 'active': -c.rowcount})
+        c.execute("UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ? WHERE id = ?",
+                 (sent, failed, job_id))
+        if cursor is not None:
+            c.execute("UPDATE broadcast_jobs SET cursor = ? WHERE id = ?", (cursor, job_id))
+            c.execute("DELETE FROM broadcast_deliveries WHERE job_id = ? AND user_id <= ?", (job_id, cursor))
+        conn.commit()
+        _blocked_users.update(blocked)
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка сохранения прогресса рассылки: {e}")
+        _rollback()
+        return False
+
+@db_task
+def set_broadcast_job_status(job_id, status):
+    """Смена статуса задания рассылки (running/paused/cancelled/done).
+
+    Статус завершённого или отменённого задания не меняется (False): иначе устаревшая кнопка
+    «пауза» вернула бы его в незавершённые, и «продолжить» разослало бы его заново.
+    """
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        finished_at = datetime.now() if status in ('cancelled', 'done') else None
+        c.execute("UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ? AND status NOT IN ('done', 'cancelled')",
+                 (status, finished_at, job_id))
+        conn.commit()
+        return c.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка смены статуса рассылки: {e}")
+        _rollback()
+        return False
+
+@db_task
+def load_fsm_record(chat_id, user_id):
+    """Чтение состояния FSM: (state, data, bucket, updated_at) или None."""
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute("SELECT state, data, bucket, updated_at FROM fsm_states WHERE chat_id = ? AND user_id = ?",
+                 (chat_id, user_id))
+        return c.fetchone()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка чтения состояния FSM: {e}")
+        return None
+
+@db_task
+def save_fsm_records(rows):
+    """Пакетная запись состояний FSM одной транзакцией.
+
+    rows — список (chat_id, user_id, state, data, bucket, updated_at); строки с data = None удаляются.
+    """
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.executemany("DELETE FROM fsm_states WHERE chat_id = ? AND user_id = ?",
+                      [(row[0], row[1]) for row in rows if row[3] is None])
+        c.executemany('''INSERT INTO fsm_states (chat_id, user_id, state, data, bucket, updated_at)
+                         VALUES (?, ?, ?, ?, ?, ?)
+                         ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                             state = excluded.state, data = excluded.data,
+                             bucket = excluded.bucket, updated_at = excluded.updated_at''',
+                      [row for row in rows if row[3] is not None])
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка записи состояний FSM: {e}")
+        _rollback()
+        return False
+
+@db_task
+def delete_stale_fsm_records(before):
+    """Удаление состояний FSM, не обновлявшихся с момента before (unix time). Возвращает число удалённых."""
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute("DELETE FROM fsm_states WHERE updated_at < ?", (before,))
+        conn.commit()
+        return c.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка удаления устаревших состояний FSM: {e}")
+        _rollback()
+        return 0
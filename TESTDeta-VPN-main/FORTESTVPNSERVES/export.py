@@ -0,0 +1,176 @@
+import csv
+import gzip
+import io
+import logging
+import sqlite3
+import tempfile
+import zlib
+from datetime import datetime
+from database import db_task, iter_user_rows, import_user_rows
+
+EXPORT_CHUNK_SIZE = 5000  # Строк, читаемых из БД за раз
+EXPORT_SPOOL_SIZE = 8 * 1024 * 1024  # Пока файл меньше, он держится в памяти, затем уходит на диск
+# Бот скачивает файлы не больше 20 МБ (лимит Bot API): часть меньше, чтобы любую выгрузку можно было
+# импортировать обратно (размер проверяется после каждой порции, с запасом на одну порцию)
+EXPORT_PART_SIZE = 19 * 1024 * 1024
+CSV_HEADER = ['TG ID', 'VPN ID', 'Username', 'Registered At']
+IMPORT_CHUNK_SIZE = 10000  # Строк импорта в одной транзакции
+IMPORT_MAX_REPORTED = 20  # Сколько конфликтов и ошибочных строк перечислить в отчёте (остальные только считаются)
+IMPORT_PROGRESS_INTERVAL = 3  # Период обновления прогресса импорта у админа, секунд
+IMPORT_DOWNLOAD_TIMEOUT = 300  # Сколько секунд ждать скачивания файла импорта
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # Больше Bot API боту файл не отдаёт
+INTERNAL_ID_MAX_LENGTH = 64  # Максимальная длина VPN ID в импортируемом файле
+
+def _open_part(compress):
+    raw = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    stream = gzip.GzipFile(fileobj=raw, mode='wb') if compress else raw
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(CSV_HEADER)
+    return raw, stream, text, writer
+
+def _close_part(raw, stream, text):
+    text.flush()
+    text.detach()
+    if stream is not raw:
+        stream.close()  # Дописывает хвост gzip, сам raw не закрывается
+    raw.seek(0)
+    return raw
+
+@db_task
+def export_users_csv(compress=True):
+    """Потоковая выгрузка пользователей в CSV (опционально gzip) с разбиением на части.
+
+    Строки читаются порциями и сразу пишутся во временный файл, поэтому память
+    ограничена размером порции и EXPORT_SPOOL_SIZE. Возвращает список (файл, имя файла);
+    файлы нужно закрыть после отправки. При ошибке возвращает None.
+    """
+    extension = "csv.gz" if compress else "csv"
+    parts = []
+    raw, stream, text, writer = _open_part(compress)
+    try:
+        for rows in iter_user_rows(EXPORT_CHUNK_SIZE):
+            writer.writerows(rows)
+            text.flush()
+            if raw.tell() >= EXPORT_PART_SIZE:
+                parts.append(_close_part(raw, stream, text))
+                raw, stream, text, writer = _open_part(compress)
+        parts.append(_close_part(raw, stream, text))
+    except (sqlite3.Error, OSError) as e:
+        logging.error(f"Ошибка выгрузки пользователей: {e}")
+        raw.close()
+        for part in parts:
+            part.close()
+        return None
+    if len(parts) == 1:
+        return [(parts[0], f"users_db.{extension}")]
+    return [(part, f"users_db.part{i}.{extension}") for i, part in enumerate(parts, 1)]
+
+def _parse_import_row(row, now):
+    """(user_id, internal_id, username, registration_date) из строки выгрузки; ValueError, если строка некорректна."""
+    if len(row) != len(CSV_HEADER):
+        raise ValueError(f"ожидается {len(CSV_HEADER)} столбца, получено {len(row)}")
+    tg_id, internal_id, username, registered_at = row
+    try:
+        user_id = int(tg_id)
+    except ValueError:
+        raise ValueError(f"TG ID не число: {tg_id[:32]!r}")
+    if user_id <= 0:
+        raise ValueError(f"TG ID должен быть положительным: {user_id}")
+    internal_id = internal_id.strip()
+    if not internal_id or len(internal_id) > INTERNAL_ID_MAX_LENGTH:
+        raise ValueError(f"некорректный VPN ID: {internal_id[:INTERNAL_ID_MAX_LENGTH]!r}")
+    if registered_at:
+        try:
+            registration_date = datetime.fromisoformat(registered_at)
+        except ValueError:
+            raise ValueError(f"некорректная дата регистрации: {registered_at[:32]!r}")
+    else:
+        # В самых старых выгрузках даты нет; без неё пользователь не попал бы в сводки регистраций
+        registration_date = now
+    return user_id, internal_id, username or None, registration_date
+
+def format_import_progress(progress, finished=False):
+    """Текст прогресса (или итогов) импорта пользователей."""
+    counts = {key: progress.get(key, 0) for key in ("rows", "inserted", "updated", "conflicts", "invalid")}
+    lines = [
+        "Импорт завершён" if finished else "Импорт пользователей...",
+        f"Обработано строк: {counts['rows']}",
+        f"Добавлено: {counts['inserted']}",
+        f"Обновлено: {counts['updated']}",
+    ]
+    if finished:
+        unchanged = counts['rows'] - counts['inserted'] - counts['updated'] - counts['conflicts'] - counts['invalid']
+        lines.append(f"Без изменений: {unchanged}")
+    lines += [
+        f"Конфликтов: {counts['conflicts']}",
+        f"Ошибочных строк: {counts['invalid']}",
+    ]
+    errors = progress.get("errors")
+    if finished and errors:
+        lines.append("")
+        lines += errors
+        skipped = counts['conflicts'] + counts['invalid'] - len(errors)
+        if skipped > 0:
+            lines.append(f"...и ещё {skipped}")
+    return "\n".join(lines)
+
+def _import_chunk(chunk, progress):
+    inserted, updated, conflicts = import_user_rows(chunk)
+    progress["inserted"] += inserted
+    progress["updated"] += updated
+    progress["conflicts"] += len(conflicts)
+    for line, reason in conflicts[:IMPORT_MAX_REPORTED - len(progress["errors"])]:
+        progress["errors"].append(f"строка {line}: {reason}")
+
+@db_task
+def import_users_csv(file, progress=None):
+    """Потоковый импорт пользователей из CSV (или .csv.gz) в формате выгрузки export_users_csv.
+
+    Файл читается построчно (gzip определяется по сигнатуре), строки проверяются и записываются
+    порциями по IMPORT_CHUNK_SIZE, каждая порция — своей транзакцией (import_user_rows), поэтому
+    память не зависит от размера файла, а регистрации не ждут окончания всего импорта.
+    Ошибочные строки и конфликты не прерывают импорт: они считаются, первые IMPORT_MAX_REPORTED
+    попадают в progress["errors"].
+
+    progress — словарь счётчиков, который обновляется по ходу импорта (по нему показывается прогресс).
+    Возвращает его же с итогами, None при ошибке БД (записанные порции остаются в базе).
+    ValueError — если файл не в формате выгрузки.
+    """
+    if progress is None:
+        progress = {}
+    progress.update(rows=0, inserted=0, updated=0, conflicts=0, invalid=0, errors=[])
+    stream = gzip.GzipFile(fileobj=file, mode='rb') if file.read(2) == b'\x1f\x8b' else file
+    file.seek(0)
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    now = datetime.now()
+    try:
+        reader = csv.reader(text)
+        header = next(reader, None)
+        if header != CSV_HEADER:
+            raise ValueError(f"ожидается заголовок {','.join(CSV_HEADER)}")
+        chunk = []
+        for row in reader:
+            progress["rows"] += 1
+            try:
+                chunk.append((reader.line_num, *_parse_import_row(row, now)))
+            except ValueError as e:
+                progress["invalid"] += 1
+                if len(progress["errors"]) < IMPORT_MAX_REPORTED:
+                    progress["errors"].append(f"строка {reader.line_num}: {e}")
+                continue
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                _import_chunk(chunk, progress)
+                chunk = []
+        if chunk:
+            _import_chunk(chunk, progress)
+    except (UnicodeDecodeError, csv.Error, EOFError, gzip.BadGzipFile, zlib.error) as e:
+        raise ValueError(f"файл не разобран: {e}")
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка импорта пользователей: {e}")
+        return None
+    finally:
+        text.detach()
+        if stream is not file:
+            stream.close()  # Сам file не закрывается
+    return progress
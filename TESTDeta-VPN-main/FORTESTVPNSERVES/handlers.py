@@ -1,17 +1,45 @@
+import asyncio
 import logging
-import io
-import csv
+import re
+import tempfile
 from aiogram import Dispatcher, types
 from aiogram.dispatcher import FSMContext
-from config import ADMIN_IDS
-from database import get_user_internal_id, register_user, update_config, get_user_stats, get_all_user_ids, get_current_config, get_all_users
-from keyboards import get_main_menu, get_admin_panel, get_broadcast_keyboard
+from aiogram.utils.exceptions import TelegramAPIError, MessageNotModified
+from config import ADMIN_IDS, EXPORT_GZIP, USERS_PAGE_SIZE
+from database import get_user_internal_id, get_user_config, register_user, update_config, get_user_stats, get_daily_registrations, get_config_snapshot, create_broadcast_job, get_broadcast_job, get_unfinished_broadcast_jobs, reactivate_user, add_pool_configs, get_users_page, find_users
+from config_pool import parse_config_file, is_per_user_template
+from keyboards import get_main_menu, get_admin_panel, get_broadcast_jobs_keyboard, get_user_stats_keyboard, get_users_page_keyboard
+from export import (export_users_csv, import_users_csv, format_import_progress, EXPORT_SPOOL_SIZE,
+                    IMPORT_PROGRESS_INTERVAL, IMPORT_DOWNLOAD_TIMEOUT, IMPORT_MAX_FILE_SIZE)
+from broadcast import start_broadcast_job, pause_broadcast_job, resume_broadcast_job, cancel_broadcast_job
+from metrics import summary_text
+from texts import get_text, load_texts
+from cluster import invalidate
 from states import UserState
 
+USERS_PAGE_TITLES = {
+    'date': "Пользователи по дате регистрации (сначала новые):",
+    'id': "Пользователи по TG ID (сначала новые):",
+    'name': "Пользователи с username на «{prefix}»:",
+}
+USERNAME_PREFIX_PATTERN = re.compile(r'\w{1,32}', re.ASCII)  # Username в Telegram: латиница, цифры, _
+
 def is_admin(user_id):
     """Проверка, является ли пользователь админом."""
     return user_id in ADMIN_IDS
 
+def format_users(title, users):
+    """Текст списка пользователей: по строке на пользователя."""
+    lines = [title]
+    for user in users:
+        username = user["username"]
+        name = f"@{username}" if username and username != "NoUsername" else "без username"
+        line = f"{user['vpn_id']} · {user['tg_id']} · {name} · {(user['registered_at'] or '')[:16]}"
+        if user["status"] == 'blocked':
+            line += " · заблокировал бота"
+        lines.append(line)
+    return "\n".join(lines)
+
 def register_handlers(dp: Dispatcher):
     """Регистрация всех обработчиков."""
 
@@ -26,14 +54,16 @@ def register_handlers(dp: Dispatcher):
         user_id = message.from_user.id
         username = message.from_user.username or "NoUsername"
 
-        internal_id = get_user_internal_id(user_id)
+        internal_id = await get_user_internal_id(user_id)
         if internal_id:
+            # Пользователь, ранее заблокировавший бота, снова получает рассылки
+            await reactivate_user(user_id)
             main_menu_message = await message.answer(
                 f"Вы зарегистрированы!\nВаш ID-VPN: {internal_id}",
                 reply_markup=get_main_menu()
             )
         else:
-            internal_id, config = register_user(user_id, username)
+            internal_id, config = await register_user(user_id, username)
             if internal_id is None or config is None:
                 await message.answer("Ошибка при генерации конфига. Попробуйте позже.")
                 return
@@ -49,10 +79,9 @@ def register_handlers(dp: Dispatcher):
     @dp.callback_query_handler(text="get_config", state=UserState.MainMenu)
     async def get_config(callback_query: types.CallbackQuery):
         user_id = callback_query.from_user.id
-        internal_id = get_user_internal_id(user_id)
+        internal_id, config_text = await get_user_config(user_id)
 
         if internal_id:
-            config_text = get_current_config()
             if config_text is None:
                 await callback_query.message.answer("Ошибка: конфиг недоступен. Обратитесь к администратору.")
                 return
@@ -63,43 +92,39 @@ def register_handlers(dp: Dispatcher):
         await callback_query.answer()
 
     @dp.callback_query_handler(text="future_plans", state=UserState.MainMenu)
-    async def show_plans(callback_query: types.CallbackQuery, state: FSMContext):
+    async def show_plans(callback_query: types.CallbackQuery, state: FSMContext, menu_edit: dict = None):
         user_data = await state.get_data()
         main_menu_message_id = user_data.get("main_menu_message_id")
 
         try:
             await callback_query.message.bot.edit_message_text(
-                text="<b>Мы держим курс в разработке быстрого и надёжного ВПН в условиях замедления и ограничений в РФ</b>, cтримясь создать конфигурации под все возможные сценарии для всех уровней пользователей, придерживаясь принципа простоты, удобства, доступа для всех желающих!\n\n"
-                     "В некотором роде, это только MVP-версия для анализа поведения и спроса потребителя. <b>Если вы заинтересованы в сотрудничестве или работе в дальнейшем: @Crypto44LDN</b>\n",
-                     # "P.S.\n"
-                     # "<blockquote><span class='tg-spoiler'>Мы помним о содержании статей УК РФ Ст. 272: «Неправомерный доступ к компьютерной информаци», Ст. 273: «Создание, использование и распространение вредоносных компьютерных программ», Ст. 274: «Нарушение правил эксплуатации средств хранения/передачи компьютерной информации», Ст. 63, Ст. 274.4 и 274.5 (от 2025 г.) и можем сказать, что не поддерживаем и не занимаемся противозаконной или преступной деятельностью. При заявлении соответствующих служб РФ в соответствии с ФЗ-374 (\"Закон Яровой\"), ФЗ-149 (\"Об информации\"), ФЗ-152 (\"О персональных данных\") мы готовы сотрудничать.\n\n"
-                     # "Все вопросы также: @Episthema</span></blockquote>"
+                text=get_text('future_plans'),
                 parse_mode='HTML',
                 chat_id=callback_query.message.chat.id,
                 message_id=main_menu_message_id,
                 reply_markup=get_main_menu()
             )
+            if menu_edit is not None:
+                menu_edit['message_id'] = main_menu_message_id  # Для антифлуда: правка прошла
         except Exception as e:
             logging.error(f"Ошибка редактирования сообщения: {e}")
 
         await callback_query.answer()
 
     @dp.callback_query_handler(text="plus", state=UserState.MainMenu)
-    async def show_plus_vpn(callback_query: types.CallbackQuery, state: FSMContext):
+    async def show_plus_vpn(callback_query: types.CallbackQuery, state: FSMContext, menu_edit: dict = None):
         user_data = await state.get_data()
         main_menu_message_id = user_data.get("main_menu_message_id")
         try:
             await callback_query.message.bot.edit_message_text(
-                text="❗️В условиях 2025-ого года, интернет по всей России был замедлен. Это связано не только с угрозой территориальной безопасности, но и с тестированием «Белых списков РФ». Многие операторы выдают низкую скорость интернета, небольшая часть осталась рабочей. <b>И это уже не сон и не слух, а реальность...</b>\n"
-                     "🤝<b>Но наша команда нашла способ, как попасть в интернет.</b> 📑С новейшим протоколом XRay это cтало возможным! А проще говоря:\n"
-                     "<b>✊С нашим ВПНом вам не страшны замедления и блокировки даже с мобильным интернетом. Вы можете не бояться о том, что ваши логи прозрачны и данные утекают.</b>\n\n"
-                     "<b>✅С НАМИ ВЫ ВСЕГДА В БЕЗОПАСНОСТИ И ВСЕГДА В СЕТИ!</b>\n\n"
-                     "<span class='tg-spoiler'><b>Кроме того, если ваш оператор сотовой связи предоставляет вам безлимит на ВК, то любой трафик через наш ВПН будет предоставлять вам безлимит.</b></span>",
+                text=get_text('plus'),
                 parse_mode='HTML',
                 chat_id=callback_query.message.chat.id,
                 message_id=main_menu_message_id,
                 reply_markup=get_main_menu()
             )
+            if menu_edit is not None:
+                menu_edit['message_id'] = main_menu_message_id  # Для антифлуда: правка прошла
         except Exception as e:
             logging.error(f"Ошибка редактирования сообщения: {e}")
 
@@ -122,7 +147,7 @@ def register_handlers(dp: Dispatcher):
             await callback_query.message.answer("У вас нет доступа.")
             return
 
-        stats = get_user_stats()
+        stats = await get_user_stats()
         if stats is None:
             await callback_query.message.answer("Ошибка базы данных. Попробуйте позже.")
             return
@@ -130,12 +155,140 @@ def register_handlers(dp: Dispatcher):
         response = (
             f"Статистика пользователей:\n"
             f"Общее количество: {stats['total']}\n"
+            f"Активных: {stats['active']}\n"
+            f"Заблокировали бота: {stats['blocked']}\n"
             f"Новых за 24 часа: {stats['24h']}\n"
             f"Новых за 3 дня: {stats['3d']}\n"
             f"Новых за неделю: {stats['7d']}\n"
-            f"Новых за месяц: {stats['30d']}"
+            f"Новых за месяц: {stats['30d']}\n"
+            f"Персональных конфигов в пуле: {stats['config_pool']}"
         )
-        await callback_query.message.answer(response)
+        await callback_query.message.answer(response, reply_markup=get_user_stats_keyboard())
+        await callback_query.answer()
+
+    @dp.callback_query_handler(text=["users_daily:30", "users_daily:90"])
+    async def view_users_daily(callback_query: types.CallbackQuery):
+        user_id = callback_query.from_user.id
+        if not is_admin(user_id):
+            await callback_query.message.answer("У вас нет доступа.")
+            return
+
+        days = int(callback_query.data.split(":")[1])
+        history = await get_daily_registrations(days)
+        if history is None:
+            await callback_query.message.answer("Ошибка базы данных. Попробуйте позже.")
+            return
+
+        lines = [f"{day}: {count}" for day, count in history]
+        await callback_query.message.answer(f"Регистрации по дням за {days} дней:\n" + "\n".join(lines))
+        await callback_query.answer()
+
+    @dp.message_handler(commands=['metrics'], state='*')
+    async def metrics_command(message: types.Message):
+        if not is_admin(message.from_user.id):
+            await message.answer("У вас нет доступа.")
+            return
+
+        await message.answer(summary_text())
+
+    async def show_users_page(message: types.Message, order, cursor=None, backward=False, prefix=None, edit=False):
+        users, more = await get_users_page(order, cursor, backward, prefix, USERS_PAGE_SIZE)
+        if users is not None and backward and not more:
+            # Листая назад, дошли до начала: показываем полную первую страницу
+            cursor, backward = None, False
+            users, more = await get_users_page(order, None, False, prefix, USERS_PAGE_SIZE)
+        if users is None:
+            await message.answer("Ошибка базы данных. Попробуйте позже.")
+            return
+
+        has_prev = more if backward else cursor is not None
+        has_next = True if backward else more
+        title = USERS_PAGE_TITLES[order].format(prefix=prefix)
+        text = format_users(title, users) if users else f"{title}\nПользователи не найдены."
+        keyboard = get_users_page_keyboard(order, users, has_prev, has_next, prefix)
+        if edit:
+            try:
+                await message.edit_text(text, reply_markup=keyboard)
+            except MessageNotModified:
+                pass
+        else:
+            await message.answer(text, reply_markup=keyboard)
+
+    @dp.callback_query_handler(text_startswith="users:")
+    async def browse_users(callback_query: types.CallbackQuery):
+        user_id = callback_query.from_user.id
+        if not is_admin(user_id):
+            await callback_query.message.answer("У вас нет доступа.")
+            return
+
+        # users:<порядок>[:<n — вперёд, p — назад>[:<TG ID курсора>[:<начало username>]]];
+        # из админ-панели список открывается новым сообщением, кнопки самого списка редактируют его
+        parts = callback_query.data.split(":", 4)
+        order = parts[1]
+        if order not in USERS_PAGE_TITLES:
+            await callback_query.answer()
+            return
+        backward = len(parts) > 2 and parts[2] == "p"
+        cursor = int(parts[3]) if len(parts) > 3 else None
+        prefix = parts[4] if len(parts) > 4 else None
+        await show_users_page(callback_query.message, order, cursor, backward, prefix, edit=len(parts) > 2)
+        await callback_query.answer()
+
+    @dp.callback_query_handler(text="user_search")
+    async def user_search_prompt(callback_query: types.CallbackQuery, state: FSMContext):
+        user_id = callback_query.from_user.id
+        if not is_admin(user_id):
+            await callback_query.message.answer("У вас нет доступа.")
+            return
+
+        await callback_query.message.answer("Введите TG ID, VPN ID или начало username:")
+        await state.set_state(UserState.AwaitingUserSearch)
+        await callback_query.answer()
+
+    @dp.message_handler(state=UserState.AwaitingUserSearch)
+    async def process_user_search(message: types.Message, state: FSMContext):
+        user_id = message.from_user.id
+        if not is_admin(user_id):
+            await message.answer("У вас нет доступа.")
+            await state.finish()
+            return
+
+        await state.finish()
+        query = (message.text or "").strip().lstrip("@")
+        users = await find_users(query)
+        if users is None:
+            await message.answer("Ошибка базы данных. Попробуйте позже.")
+        elif users:
+            await message.answer(format_users("Найдено по TG ID / VPN ID:", users),
+                                 reply_markup=get_users_page_keyboard('id', users, False, False))
+        elif USERNAME_PREFIX_PATTERN.fullmatch(query):
+            await show_users_page(message, 'name', prefix=query)
+        else:
+            await message.answer("Пользователи не найдены.")
+
+    @dp.message_handler(commands=['reload_texts'], state='*')
+    async def reload_texts_command(message: types.Message):
+        if not is_admin(message.from_user.id):
+            await message.answer("У вас нет доступа.")
+            return
+
+        try:
+            names = load_texts()
+        except (OSError, ValueError) as e:
+            await message.answer(f"Тексты не обновлены (остались прежние): {e}")
+            return
+        invalidate('texts')
+        await message.answer(f"Тексты обновлены: {', '.join(names)}")
+        logging.info(f"Админ {message.from_user.id} перезагрузил тексты: {', '.join(names)}")
+
+    @dp.callback_query_handler(text="metrics")
+    async def view_metrics(callback_query: types.CallbackQuery):
+        user_id = callback_query.from_user.id
+        if not is_admin(user_id):
+            await callback_query.message.answer("У вас нет доступа.")
+            return
+
+        await callback_query.message.answer(summary_text())
         await callback_query.answer()
 
     @dp.callback_query_handler(text="download_db")
@@ -145,28 +298,98 @@ def register_handlers(dp: Dispatcher):
             await callback_query.message.answer("У вас нет доступа.")
             return
 
-        users = get_all_users()
-        if users is None:
+        parts = await export_users_csv(compress=EXPORT_GZIP)
+        if parts is None:
             await callback_query.message.answer("Ошибка базы данных. Попробуйте позже.")
             return
 
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(['TG ID', 'VPN ID', 'Username', 'Registered At'])
-
-        for user in users:
-            writer.writerow([user['tg_id'], user['vpn_id'], user['username'], user['registered_at']])
+        try:
+            for i, (part, filename) in enumerate(parts, 1):
+                caption = "Выкачанная база данных пользователей (CSV)"
+                if len(parts) > 1:
+                    caption += f", часть {i}/{len(parts)}"
+                await callback_query.message.bot.send_document(
+                    chat_id=callback_query.message.chat.id,
+                    document=types.InputFile(part, filename=filename),
+                    caption=caption
+                )
+        finally:
+            for part, _ in parts:
+                part.close()
+        await callback_query.answer()
 
-        output.seek(0)
-        file = types.InputFile(output, filename="users_db.csv")
+    @dp.callback_query_handler(text="import_db")
+    async def import_db_prompt(callback_query: types.CallbackQuery, state: FSMContext):
+        user_id = callback_query.from_user.id
+        if not is_admin(user_id):
+            await callback_query.message.answer("У вас нет доступа.")
+            return
 
-        await callback_query.message.bot.send_document(
-            chat_id=callback_query.message.chat.id,
-            document=file,
-            caption="Выкачанная база данных пользователей (CSV)"
+        await callback_query.message.answer(
+            "Отправьте файл выгрузки (.csv или .csv.gz в формате «Выкачать БД»).\n"
+            "Новые пользователи будут добавлены; строки, чей TG ID или VPN ID уже занят другим "
+            "пользователем, пропускаются и попадут в отчёт. /cancel — отмена."
         )
+        await state.set_state(UserState.AwaitingImportFile)
         await callback_query.answer()
 
+    @dp.message_handler(content_types=['document'], state=UserState.AwaitingImportFile)
+    async def process_import_file(message: types.Message, state: FSMContext):
+        user_id = message.from_user.id
+        if not is_admin(user_id):
+            await message.answer("У вас нет доступа.")
+            await state.finish()
+            return
+
+        if message.document.file_size and message.document.file_size > IMPORT_MAX_FILE_SIZE:
+            # Скачивание всё равно завершилось бы ошибкой Bot API; состояние сохраняется, чтобы прислать части
+            await message.answer(
+                f"Файл больше {IMPORT_MAX_FILE_SIZE // (1024 * 1024)} МБ: бот не может его скачать. "
+                "Отправьте выгрузку по частям или сжатую (.csv.gz). /cancel — отмена."
+            )
+            return
+
+        await state.finish()
+        file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        try:
+            try:
+                await message.bot.download_file_by_id(message.document.file_id, destination=file,
+                                                      timeout=IMPORT_DOWNLOAD_TIMEOUT)
+            except (TelegramAPIError, asyncio.TimeoutError) as e:
+                await message.answer(f"Не удалось скачать файл: {e}")
+                return
+
+            progress = {}
+            progress_message = await message.answer("Импорт пользователей...")
+
+            async def report_progress():
+                while True:
+                    await asyncio.sleep(IMPORT_PROGRESS_INTERVAL)
+                    try:
+                        await progress_message.edit_text(format_import_progress(progress))
+                    except MessageNotModified:
+                        pass
+                    except TelegramAPIError as e:
+                        logging.error(f"Ошибка обновления прогресса импорта: {e}")
+
+            reporter = asyncio.create_task(report_progress())
+            try:
+                result = await import_users_csv(file, progress)
+            except ValueError as e:
+                await message.answer(f"Не удалось импортировать файл: {e}")
+                return
+            finally:
+                reporter.cancel()
+        finally:
+            file.close()
+
+        if result is None:
+            await message.answer("Ошибка базы данных, импорт прерван.\n" + format_import_progress(progress))
+            return
+        await message.answer(format_import_progress(result, finished=True))
+        logging.info(f"Админ {user_id} импортировал пользователей: добавлено {result['inserted']}, "
+                     f"обновлено {result['updated']}, конфликтов {result['conflicts']}, ошибок {result['invalid']}")
+
     @dp.callback_query_handler(text="set_config")
     async def set_config_prompt(callback_query: types.CallbackQuery, state: FSMContext):
         user_id = callback_query.from_user.id
@@ -187,14 +410,55 @@ def register_handlers(dp: Dispatcher):
             return
 
         new_config = message.text
-        if update_config(new_config):
+        if await update_config(new_config):
+            invalidate('config')
             await message.answer(f"Конфиг обновлен: {new_config}")
-            logging.info(f"Админ {user_id} обновил конфиг на: {new_config}")
+            if is_per_user_template(new_config):
+                await message.answer("Новые пользователи получат персональные конфиги по этому шаблону.")
+            logging.info(f"Админ {user_id} обновил конфиг (версия {get_config_snapshot()[1]}) на: {new_config}")
         else:
             await message.answer("Ошибка базы данных. Попробуйте позже.")
 
         await state.finish()
 
+    @dp.callback_query_handler(text="load_configs")
+    async def load_configs_prompt(callback_query: types.CallbackQuery, state: FSMContext):
+        user_id = callback_query.from_user.id
+        if not is_admin(user_id):
+            await callback_query.message.answer("У вас нет доступа.")
+            return
+
+        await callback_query.message.answer(
+            "Отправьте файл с конфигами: .txt — по одному конфигу на строку, .json — массив конфигов.\n"
+            "Конфиги попадут в пул и будут выдаваться новым пользователям. /cancel — отмена."
+        )
+        await state.set_state(UserState.AwaitingConfigFile)
+        await callback_query.answer()
+
+    @dp.message_handler(content_types=['document'], state=UserState.AwaitingConfigFile)
+    async def process_config_file(message: types.Message, state: FSMContext):
+        user_id = message.from_user.id
+        if not is_admin(user_id):
+            await message.answer("У вас нет доступа.")
+            await state.finish()
+            return
+
+        file = await message.bot.download_file_by_id(message.document.file_id)
+        try:
+            configs = parse_config_file(file.getvalue(), message.document.file_name or '')
+        except ValueError as e:
+            await message.answer(f"Не удалось разобрать файл: {e}")
+            return
+
+        added = await add_pool_configs(configs)
+        if added is None:
+            await message.answer("Ошибка базы данных. Попробуйте позже.")
+        else:
+            invalidate('config')
+            await message.answer(f"Загружено конфигов: {added}, пропущено повторов: {len(configs) - added}.")
+            logging.info(f"Админ {user_id} загрузил в пул {added} конфигов")
+        await state.finish()
+
     @dp.callback_query_handler(text="broadcast")
     async def broadcast_prompt(callback_query: types.CallbackQuery, state: FSMContext):
         user_id = callback_query.from_user.id
@@ -271,32 +535,67 @@ def register_handlers(dp: Dispatcher):
         broadcast_text = user_data.get("broadcast_text")
         broadcast_photo = user_data.get("broadcast_photo")
         broadcast_url = user_data.get("broadcast_url")
-
-        user_ids = get_all_user_ids()
-        sent_count = 0
-        for user_id in user_ids:
-            try:
-                keyboard = get_broadcast_keyboard(broadcast_url)
-                if broadcast_photo:
-                    await message.bot.send_photo(
-                        chat_id=user_id,
-                        photo=broadcast_photo,
-                        caption=broadcast_text,
-                        reply_markup=keyboard
-                    )
-                else:
-                    await message.bot.send_message(
-                        chat_id=user_id,
-                        text=broadcast_text,
-                        reply_markup=keyboard
-                    )
-                sent_count += 1
-            except Exception as e:
-                logging.error(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
-
-        await message.answer(f"Рассылка завершена. Отправлено {sent_count} сообщений.")
         await state.finish()
 
+        job_id = await create_broadcast_job(broadcast_text, broadcast_photo, broadcast_url, message.chat.id)
+        if job_id is None:
+            await message.answer("Ошибка базы данных. Попробуйте позже.")
+            return
+
+        start_broadcast_job(message.bot, job_id)
+        await message.answer(f"Рассылка #{job_id} запущена. Управление — в админ-панели.")
+
+    @dp.callback_query_handler(text="broadcast_jobs")
+    async def broadcast_jobs(callback_query: types.CallbackQuery):
+        user_id = callback_query.from_user.id
+        if not is_admin(user_id):
+            await callback_query.message.answer("У вас нет доступа.")
+            return
+
+        jobs = await get_unfinished_broadcast_jobs()
+        if not jobs:
+            await callback_query.message.answer("Нет незавершённых рассылок.")
+            await callback_query.answer()
+            return
+
+        statuses = {"pending": "в очереди", "running": "выполняется", "paused": "на паузе"}
+        lines = [
+            f"#{job['id']}: {statuses[job['status']]}, {job['sent'] + job['failed']}/{job['total']}"
+            for job in jobs
+        ]
+        await callback_query.message.answer(
+            "Рассылки:\n" + "\n".join(lines),
+            reply_markup=get_broadcast_jobs_keyboard(jobs)
+        )
+        await callback_query.answer()
+
+    @dp.callback_query_handler(text_startswith=["job_pause:", "job_resume:", "job_cancel:"])
+    async def control_broadcast_job(callback_query: types.CallbackQuery):
+        user_id = callback_query.from_user.id
+        if not is_admin(user_id):
+            await callback_query.message.answer("У вас нет доступа.")
+            return
+
+        action, job_id = callback_query.data.split(":")
+        job_id = int(job_id)
+        if action == "job_pause":
+            ok = await pause_broadcast_job(job_id)
+            result = f"Рассылка #{job_id} поставлена на паузу."
+        elif action == "job_resume":
+            ok = await resume_broadcast_job(callback_query.message.bot, job_id)
+            result = f"Рассылка #{job_id} продолжена."
+        else:
+            ok = await cancel_broadcast_job(job_id)
+            result = f"Рассылка #{job_id} отменена."
+
+        if not ok:
+            job = await get_broadcast_job(job_id)
+            if job is not None and job["status"] in ('done', 'cancelled'):
+                result = f"Рассылка #{job_id} уже завершена."
+            else:
+                result = "Не удалось изменить рассылку."
+        await callback_query.answer(result)
+
     @dp.callback_query_handler(text="delete_broadcast")
     async def delete_broadcast_message(callback_query: types.CallbackQuery):
         try:
@@ -0,0 +1,33 @@
+import hashlib
+
+INTERNAL_ID_PREFIX = "VPN-"
+INTERNAL_ID_MIN = 1000  # Старые ID VPN-100..VPN-999 остаются вне нового диапазона
+INTERNAL_ID_SPACE = 100_000_000  # Размер пространства новых ID
+FEISTEL_ROUNDS = 4
+
+def _round(value, key, round_no, mask):
+    digest = hashlib.blake2b(f"{key}:{round_no}:{value}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') & mask
+
+def permute(n, key, space=INTERNAL_ID_SPACE):
+    """Биекция [0, space) -> [0, space): сеть Фейстеля с cycle walking.
+
+    Соседние значения счётчика дают непохожие ID, а уникальность гарантируется
+    без проверок в базе: разные n всегда переходят в разные значения.
+    """
+    if not 0 <= n < space:
+        raise ValueError(f"Номер {n} вне пространства ID (0..{space - 1})")
+    half_bits = ((space - 1).bit_length() + 1) // 2
+    mask = (1 << half_bits) - 1
+    value = n
+    while True:
+        left, right = value >> half_bits, value & mask
+        for round_no in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ _round(right, key, round_no, mask)
+        value = (left << half_bits) | right
+        if value < space:
+            return value
+
+def format_internal_id(n, key, space=INTERNAL_ID_SPACE):
+    """internal_id для n-го по счёту пользователя."""
+    return f"{INTERNAL_ID_PREFIX}{INTERNAL_ID_MIN + permute(n, key, space)}"
@@ -1,7 +1,19 @@
+import functools
+import json
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from config import SUPPORT_USERNAME
 
-def get_main_menu():
+BROADCAST_KEYBOARD_CACHE_SIZE = 256  # Сколько клавиатур рассылки (по URL) держать готовыми
+
+def _render(keyboard):
+    """Клавиатура, один раз сериализованная в JSON.
+
+    aiogram передаёт строку в Bot API как есть: при отправке не создаются объекты кнопок
+    и не вызываются to_python/json.dumps, как для InlineKeyboardMarkup.
+    """
+    return json.dumps(keyboard.to_python())
+
+def _build_main_menu():
     """Создание главного меню с инлайн-кнопками."""
     keyboard = InlineKeyboardMarkup(row_width=1)
     keyboard.add(
@@ -13,24 +25,41 @@ def get_main_menu():
     )
     return keyboard
 
-def get_admin_panel():
+MAIN_MENU = _render(_build_main_menu())
+
+def get_main_menu():
+    """Главное меню (готовая разметка, собирается один раз при импорте)."""
+    return MAIN_MENU
+
+def _build_admin_panel():
     """Создание клавиатуры админ-панели."""
     keyboard = InlineKeyboardMarkup(row_width=1)
     keyboard.add(
         InlineKeyboardButton("БД пользователей", callback_data="view_users"),
+        InlineKeyboardButton("Список пользователей", callback_data="users:date"),
         InlineKeyboardButton("Выкачать БД", callback_data="download_db"),
+        InlineKeyboardButton("Загрузить БД", callback_data="import_db"),
         InlineKeyboardButton("Изменить конфиг", callback_data="set_config"),
-        InlineKeyboardButton("Отправить рассылку", callback_data="broadcast") 
+        InlineKeyboardButton("Загрузить конфиги", callback_data="load_configs"),
+        InlineKeyboardButton("Отправить рассылку", callback_data="broadcast"),
+        InlineKeyboardButton("Управление рассылками", callback_data="broadcast_jobs"),
+        InlineKeyboardButton("Метрики", callback_data="metrics")
     )
     return keyboard
 
+ADMIN_PANEL = _render(_build_admin_panel())
+
+def get_admin_panel():
+    """Клавиатура админ-панели (готовая разметка)."""
+    return ADMIN_PANEL
+
 # def get_agreement_keyboard():
 #     """Создание клавиатуры для соглашения."""
 #     keyboard = InlineKeyboardMarkup()
 #     keyboard.add(InlineKeyboardButton("☑️Я соглашаюсь☑️", callback_data="agree"))
 #     return keyboard
 
-def get_broadcast_keyboard(url=None):
+def _build_broadcast_keyboard(url=None):
     """Создание клавиатуры для рассылки с опциональной ссылкой и кнопкой удаления."""
     keyboard = InlineKeyboardMarkup()
     if url:
@@ -38,3 +67,54 @@ def get_broadcast_keyboard(url=None):
     keyboard.add(InlineKeyboardButton("❌Удалить сообщение❌", callback_data="delete_broadcast"))
 
     return keyboard
+
+@functools.lru_cache(maxsize=BROADCAST_KEYBOARD_CACHE_SIZE)
+def get_broadcast_keyboard(url=None):
+    """Клавиатура рассылки (готовая разметка, собирается один раз для каждого URL)."""
+    return _render(_build_broadcast_keyboard(url))
+
+def get_broadcast_jobs_keyboard(jobs):
+    """Создание клавиатуры управления незавершёнными рассылками."""
+    keyboard = InlineKeyboardMarkup(row_width=3)
+    for job in jobs:
+        if job["status"] == "paused":
+            toggle = InlineKeyboardButton(f"▶️ #{job['id']}", callback_data=f"job_resume:{job['id']}")
+        else:
+            toggle = InlineKeyboardButton(f"⏸ #{job['id']}", callback_data=f"job_pause:{job['id']}")
+        keyboard.row(toggle, InlineKeyboardButton(f"✖️ #{job['id']}", callback_data=f"job_cancel:{job['id']}"))
+    keyboard.add(InlineKeyboardButton("🔄 Обновить", callback_data="broadcast_jobs"))
+    return keyboard
+
+def _build_user_stats_keyboard():
+    """Создание клавиатуры с разбивкой регистраций по дням."""
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("По дням: 30", callback_data="users_daily:30"),
+        InlineKeyboardButton("По дням: 90", callback_data="users_daily:90")
+    )
+    return keyboard
+
+USER_STATS_KEYBOARD = _render(_build_user_stats_keyboard())
+
+def get_user_stats_keyboard():
+    """Клавиатура с разбивкой регистраций по дням (готовая разметка)."""
+    return USER_STATS_KEYBOARD
+
+def get_users_page_keyboard(order, users, has_prev, has_next, prefix=None):
+    """Создание клавиатуры страницы списка пользователей: листание (курсор — TG ID крайнего
+    пользователя страницы), смена порядка и поиск."""
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    suffix = f":{prefix}" if prefix else ""
+    pages = []
+    if has_prev and users:
+        pages.append(InlineKeyboardButton("◀️ Назад", callback_data=f"users:{order}:p:{users[0]['tg_id']}{suffix}"))
+    if has_next and users:
+        pages.append(InlineKeyboardButton("Далее ▶️", callback_data=f"users:{order}:n:{users[-1]['tg_id']}{suffix}"))
+    if pages:
+        keyboard.row(*pages)
+    keyboard.row(
+        InlineKeyboardButton("По дате", callback_data="users:date:n"),
+        InlineKeyboardButton("По TG ID", callback_data="users:id:n")
+    )
+    keyboard.add(InlineKeyboardButton("🔍 Найти пользователя", callback_data="user_search"))
+    return keyboard
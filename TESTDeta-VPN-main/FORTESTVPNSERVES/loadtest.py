@@ -0,0 +1,723 @@
+"""
+Нагрузочное тестирование бота без обращения к настоящему Telegram.
+
+Поднимает локальную заглушку Bot API (getUpdates, sendMessage, sendPhoto, editMessageText,
+sendDocument и др.) с настраиваемой задержкой и долей ответов 429, запускает настоящий
+register_handlers(dp) на временной базе и проигрывает сценарии пользователей и админа.
+Каждый сценарий выполняется в отдельном процессе, чтобы честно измерить пиковый RSS.
+
+Пример:
+    python loadtest.py --scenario users --users 500 --mode polling
+    python loadtest.py --scenario all --latency 30 --rate-429 0.01 --label after-cache
+    python loadtest.py --scenario export --seed 300000 --journal-mode delete --label rollback-journal
+    python loadtest.py --scenario import --seed 1000000
+    python loadtest.py --scenario render
+    python loadtest.py --scenario ids --seed 100000
+    python loadtest.py --scenario burst --users 5000
+    python loadtest.py --scenario users --users 1000 --mode webhook --workers 4
+
+Сценарии export и import обходятся без бота: измеряют пропускную способность регистраций (запись)
+и чтений internal_id в покое и во время выгрузки export_users_csv (импорта import_users_csv
+файла из --seed строк) на той же базе. Сценарий render — микробенчмарк подготовки клавиатур
+к отправке (как это делает aiogram для каждого запроса): сборка на каждый вызов против готовой разметки.
+Сценарий ids регистрирует --seed новых пользователей (--users одновременно) и проверяет выданные
+internal_id: все разные, лежат в пространстве ID и выданы по счётчику подряд, без пропусков из-за совпадений.
+Сценарий burst одновременно отправляет --users вызовов register_user (часть — повторные /start тех же
+пользователей) и показывает размеры пачек группового коммита; проверяется, что все регистрации
+успешны, а повторы получили тот же internal_id, что и первый вызов.
+Непройденные проверки печатаются в конце, и loadtest.py завершается с кодом 1.
+С --workers N бот запускается так же, как с WORKERS = N в config.py: приёмник в процессе сценария
+раздаёт обновления N процессам-воркерам; в результатах — процессорное время на шаг у приёмника и у воркеров.
+"""
+import argparse
+import asyncio
+import csv
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from aiohttp import web, ClientSession
+
+FAKE_TOKEN = '123456789:LOADTEST-token-for-fake-telegram-api'
+RESULTS_PATH = 'loadtest_results.json'
+RESPONSE_METHODS = {'sendMessage', 'sendPhoto', 'editMessageText', 'sendDocument', 'answerCallbackQuery'}
+RENDER_ITERATIONS = 20000  # Вызовов на каждый вариант в сценарии render
+
+class FakeTelegram:
+    """Локальная заглушка Bot API: отдаёт обновления через getUpdates и фиксирует ответы бота."""
+
+    def __init__(self, latency=0.0, rate_429=0.0):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.updates = []
+        self.updates_event = asyncio.Event()
+        self.waiters = {}  # ключ (чат или callback_query_id) -> [(предикат, future)]
+        self.calls = {}
+        self.message_ids = itertools.count(1)
+
+    def push_update(self, update):
+        self.updates.append(update)
+        self.updates_event.set()
+
+    def wait_for(self, key, predicate=None):
+        """Future, который завершится, когда бот ответит в чат/на callback key."""
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(key, []).append((predicate, future))
+        return future
+
+    def _notify(self, key, method, params):
+        waiters = self.waiters.get(key)
+        if not waiters:
+            return
+        for item in waiters:
+            predicate, future = item
+            if not future.done() and (predicate is None or predicate(method, params)):
+                future.set_result(time.perf_counter())
+                waiters.remove(item)
+                break
+        if not waiters:
+            del self.waiters[key]
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in RESPONSE_METHODS and method != 'answerCallbackQuery' and random.random() < self.rate_429:
+            return web.json_response({'ok': False, 'error_code': 429,
+                                      'description': 'Too Many Requests: retry after 1',
+                                      'parameters': {'retry_after': 1}})
+        result = self._result(method, params)
+        if method in RESPONSE_METHODS:
+            key = f"cq:{params['callback_query_id']}" if method == 'answerCallbackQuery' else f"chat:{params.get('chat_id')}"
+            self._notify(key, method, params)
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _get_updates(self, params):
+        timeout = float(params.get('timeout') or 0)
+        if not self.updates and timeout:
+            self.updates_event.clear()
+            try:
+                await asyncio.wait_for(self.updates_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        updates, self.updates = self.updates, []
+        return web.json_response({'ok': True, 'result': updates})
+
+    def _result(self, method, params):
+        if method == 'getMe':
+            return {'id': 123456789, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+        if method in ('sendMessage', 'sendPhoto', 'editMessageText', 'sendDocument'):
+            chat_id = int(params.get('chat_id') or 0)
+            return {'message_id': int(params.get('message_id') or next(self.message_ids)), 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text') or params.get('caption') or ''}
+        return True
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+class UpdateFactory:
+    """Построение обновлений Telegram для сценариев."""
+
+    def __init__(self):
+        self.update_ids = itertools.count(1)
+        self.callback_ids = itertools.count(1)
+
+    def message(self, user_id, text):
+        update = {'update_id': next(self.update_ids), 'message': {
+            'message_id': next(self.update_ids), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'}, 'from': _user(user_id), 'text': text}}
+        if text.startswith('/'):
+            update['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return update
+
+    def callback(self, user_id, data):
+        callback_id = str(next(self.callback_ids))
+        update = {'update_id': next(self.update_ids), 'callback_query': {
+            'id': callback_id, 'from': _user(user_id), 'chat_instance': str(user_id), 'data': data,
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'},
+                        'text': 'menu'}}}
+        return update, callback_id
+
+class Harness:
+    """Запуск бота против заглушки и проигрывание шагов сценариев с замером задержки."""
+
+    def __init__(self, fake, mode, webhook_url=None, step_timeout=15):
+        self.fake = fake
+        self.mode = mode
+        self.step_timeout = step_timeout
+        self.webhook_url = webhook_url
+        self.factory = UpdateFactory()
+        self.latencies = {}  # шаг -> [секунды]
+        self.session = None
+        self.deliveries = set()  # Запросы на вебхук, ещё не получившие ответ
+
+    async def _deliver(self, update):
+        if self.mode == 'webhook':
+            async with self.session.post(self.webhook_url, json=update) as response:
+                await response.read()
+        else:
+            self.fake.push_update(update)
+
+    async def step(self, name, user_id, text=None, callback=None, predicate=None, timeout=None):
+        """Отправка одного обновления и ожидание ответа бота."""
+        if callback is not None:
+            update, callback_id = self.factory.callback(user_id, callback)
+            waiter = self.fake.wait_for(f"cq:{callback_id}", predicate)
+        else:
+            update = self.factory.message(user_id, text)
+            waiter = self.fake.wait_for(f"chat:{user_id}", predicate)
+        started = time.perf_counter()
+        delivery = asyncio.create_task(self._deliver(update))
+        self.deliveries.add(delivery)
+        delivery.add_done_callback(self.deliveries.discard)
+        timeout = timeout or self.step_timeout
+        try:
+            finished = await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            self.latencies.setdefault(f"{name}:timeout", []).append(timeout)
+            return
+        self.latencies.setdefault(name, []).append(finished - started)
+
+async def user_session(harness, user_id, rounds):
+    """/start -> get_config -> plus -> future_plans."""
+    for _ in range(rounds):
+        await harness.step('start', user_id, text='/start')
+        await harness.step('get_config', user_id, callback='get_config')
+        await harness.step('plus', user_id, callback='plus')
+        await harness.step('future_plans', user_id, callback='future_plans')
+
+async def admin_session(harness, admin_id):
+    """Статистика, список и поиск пользователей, выгрузка CSV и рассылка от начала до конца."""
+    await harness.step('admin', admin_id, text='/admin')
+    await harness.step('view_users', admin_id, callback='view_users')
+    await harness.step('users_page', admin_id, callback='users:date')
+    await harness.step('users_page_by_id', admin_id, callback='users:id:n')
+    await harness.step('user_search_prompt', admin_id, callback='user_search')
+    await harness.step('user_search', admin_id, text='user')
+    await harness.step('download_db', admin_id, callback='download_db')
+    await harness.step('broadcast_prompt', admin_id, callback='broadcast')
+    await harness.step('broadcast_text', admin_id, text='Нагрузочная рассылка')
+    await harness.step('broadcast_skip_photo', admin_id, text='/skip')
+    finished = lambda method, params: 'завершена' in (params.get('text') or '')
+    await harness.step('broadcast_total', admin_id, text='/skip', predicate=finished, timeout=3600)
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _steps_summary(latencies):
+    return {
+        name: {
+            'count': len(values),
+            'p50_ms': round(_percentile(values, 0.50) * 1000, 2),
+            'p95_ms': round(_percentile(values, 0.95) * 1000, 2),
+            'p99_ms': round(_percentile(values, 0.99) * 1000, 2),
+        } for name, values in sorted(latencies.items())
+    }
+
+def _write_import_file(rows):
+    """CSV в формате выгрузки: rows пользователей со случайными internal_id (часть совпадёт с выдаваемыми ботом)."""
+    from datetime import datetime
+    from export import CSV_HEADER
+    from identifiers import INTERNAL_ID_PREFIX, INTERNAL_ID_MIN, INTERNAL_ID_SPACE
+    file = tempfile.TemporaryFile()
+    text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(CSV_HEADER)
+    registered_at = datetime.now()
+    for i, n in enumerate(random.sample(range(INTERNAL_ID_SPACE), rows)):
+        writer.writerow([10 ** 9 + i, f"{INTERNAL_ID_PREFIX}{INTERNAL_ID_MIN + n}", f'import{i}', registered_at])
+    text.flush()
+    text.detach()
+    file.seek(0)
+    return file
+
+async def _run_db_benchmark(args):
+    """Регистрации и чтения параллельно с выгрузкой или импортом CSV: сравнение с теми же операциями в покое."""
+    import database
+    from export import export_users_csv, import_users_csv
+    database.DATABASE_PATH = os.path.join(tempfile.mkdtemp(prefix='loadtest-'), 'users.db')
+    database.DB_JOURNAL_MODE = args.journal_mode
+    database.init_db()
+    if args.scenario == 'import':
+        import_file = _write_import_file(args.seed)
+    else:
+        for start in range(0, args.seed, 10000):
+            database.register_users_batch.sync([(10 ** 9 + i, f'seed{i}') for i in range(start, min(start + 10000, args.seed))])
+    new_ids = itertools.count(2 * 10 ** 9)
+    latencies = {}
+    rates = {}
+
+    async def writer(phase, running):
+        while running():
+            started = time.perf_counter()
+            internal_id, _ = await database.register_user(next(new_ids), 'bench')
+            name = f"register_{phase}" if internal_id else f"register_{phase}:failed"
+            latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+    async def reader(phase, running):
+        while running():
+            started = time.perf_counter()
+            await database.load_user_internal_id(10 ** 9 + random.randrange(max(args.seed, 1)))
+            latencies.setdefault(f"read_{phase}", []).append(time.perf_counter() - started)
+
+    async def run_phase(phase, running):
+        started = time.perf_counter()
+        await asyncio.gather(*(writer(phase, running) for _ in range(args.users)),
+                             *(reader(phase, running) for _ in range(args.users)))
+        elapsed = time.perf_counter() - started
+        for kind in ('register', 'read'):
+            rates[f"{kind}_{phase}_per_s"] = round(len(latencies.get(f"{kind}_{phase}", [])) / elapsed, 1)
+
+    idle_until = time.perf_counter() + args.bench_seconds
+    await run_phase('idle', lambda: time.perf_counter() < idle_until)
+
+    phase = args.scenario
+    started = time.perf_counter()
+    if phase == 'import':
+        task = asyncio.create_task(import_users_csv(import_file))
+    else:
+        task = asyncio.create_task(export_users_csv())
+    await run_phase(phase, lambda: not task.done())
+    result = await task
+    latencies[phase] = [time.perf_counter() - started]
+    if phase == 'import':
+        import_file.close()
+        rates['import_rows_per_s'] = round(args.seed / latencies[phase][0], 1)
+        if result is not None:
+            for key in ('inserted', 'conflicts', 'invalid'):
+                rates[f"import_{key}"] = result[key]
+    else:
+        for file, _ in result or []:
+            file.close()
+
+    await database.stop_registration_writer()
+    database.close_db()
+    steps = sum(len(values) for name, values in latencies.items() if name != phase)
+    elapsed = args.bench_seconds + latencies[phase][0]
+    return {
+        'scenario': phase,
+        'mode': f"journal={args.journal_mode}",
+        'elapsed_s': round(elapsed, 3),
+        'throughput_steps_per_s': round(steps / elapsed, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'rates': rates,
+        'steps': _steps_summary(latencies),
+    }
+
+async def _run_ids_benchmark(args):
+    """Регистрация --seed пользователей через register_user и проверка уникальности выданных internal_id."""
+    import database
+    from identifiers import INTERNAL_ID_PREFIX, INTERNAL_ID_MIN, INTERNAL_ID_SPACE, format_internal_id
+    database.DATABASE_PATH = os.path.join(tempfile.mkdtemp(prefix='loadtest-'), 'users.db')
+    database.init_db()
+    user_ids = iter(range(10 ** 9, 10 ** 9 + args.seed))
+    issued = {}
+    latencies = {}
+
+    async def writer():
+        for user_id in user_ids:
+            started = time.perf_counter()
+            internal_id, _ = await database.register_user(user_id, 'bench')
+            latencies.setdefault('register' if internal_id else 'register:failed', []).append(time.perf_counter() - started)
+            issued[user_id] = internal_id
+
+    started = time.perf_counter()
+    await asyncio.gather(*(writer() for _ in range(args.users)))
+    elapsed = time.perf_counter() - started
+    await database.stop_registration_writer()
+    database.close_db()
+
+    conn = sqlite3.connect(database.DATABASE_PATH)
+    next_value, seed = conn.execute("SELECT next_value, seed FROM id_sequence WHERE name = 'internal_id'").fetchone()
+    stored, stored_distinct = conn.execute("SELECT COUNT(*), COUNT(DISTINCT internal_id) FROM users").fetchone()
+    conn.close()
+    internal_ids = [internal_id for internal_id in issued.values() if internal_id]
+    numbers = [int(internal_id[len(INTERNAL_ID_PREFIX):]) for internal_id in internal_ids
+               if internal_id.startswith(INTERNAL_ID_PREFIX) and internal_id[len(INTERNAL_ID_PREFIX):].isdigit()]
+    # На чистой базе n-й пользователь получает ровно format_internal_id(n): любой пропуск номера — совпадение
+    expected = {format_internal_id(n, seed) for n in range(next_value)}
+    rates = {
+        'failed': len(issued) - len(internal_ids),
+        'duplicate_ids': len(internal_ids) - len(set(internal_ids)),
+        'stored_duplicate_ids': stored - stored_distinct,
+        'out_of_range_ids': len(internal_ids) - sum(INTERNAL_ID_MIN <= n < INTERNAL_ID_MIN + INTERNAL_ID_SPACE for n in numbers),
+        'skipped_numbers': next_value - args.seed,
+        'unexpected_ids': len(set(internal_ids) - expected),
+    }
+    checks = {
+        'все регистрации успешны': rates['failed'] == 0 and stored == args.seed,
+        'internal_id уникальны': rates['duplicate_ids'] == 0 and rates['stored_duplicate_ids'] == 0,
+        'internal_id в пространстве ID': rates['out_of_range_ids'] == 0,
+        'без совпадений и пропусков': rates['skipped_numbers'] == 0 and rates['unexpected_ids'] == 0,
+    }
+    return {
+        'scenario': 'ids',
+        'mode': 'in-process',
+        'elapsed_s': round(elapsed, 3),
+        'throughput_steps_per_s': round(len(issued) / elapsed, 1) if elapsed else 0,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'rates': rates,
+        'checks': checks,
+        'steps': _steps_summary(latencies),
+    }
+
+async def _run_burst_benchmark(args):
+    """Одновременные регистрации: размеры пачек группового коммита, отсутствие ошибок и повторов internal_id."""
+    import database
+    database.DATABASE_PATH = os.path.join(tempfile.mkdtemp(prefix='loadtest-'), 'users.db')
+    database.init_db()
+    batch_sizes = []
+    register_users_batch = database.register_users_batch
+
+    async def counted_batch(users):
+        batch_sizes.append(len(users))
+        return await register_users_batch(users)
+
+    # Писатель регистраций берёт register_users_batch из модуля при каждом коммите
+    database.register_users_batch = counted_batch
+    # Каждый пятидесятый вызов — повторный /start уже отправленного пользователя
+    calls = [10 ** 9 + (i - 1 if i % 50 == 49 else i) for i in range(args.users)]
+    latencies = {}
+
+    async def register(user_id):
+        started = time.perf_counter()
+        internal_id, _ = await database.register_user(user_id, 'burst')
+        latencies.setdefault('register' if internal_id else 'register:failed', []).append(time.perf_counter() - started)
+        return user_id, internal_id
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(register(user_id) for user_id in calls))
+    elapsed = time.perf_counter() - started
+    await database.stop_registration_writer()
+    database.register_users_batch = register_users_batch
+    database.close_db()
+
+    conn = sqlite3.connect(database.DATABASE_PATH)
+    stored, stored_distinct = conn.execute("SELECT COUNT(*), COUNT(DISTINCT internal_id) FROM users").fetchone()
+    conn.close()
+    by_user = {}
+    for user_id, internal_id in results:
+        by_user.setdefault(user_id, set()).add(internal_id)
+    internal_ids = [internal_id for ids in by_user.values() for internal_id in ids if internal_id]
+    rates = {
+        'users': len(by_user),
+        'commits': len(batch_sizes),
+        'batch_size_mean': round(sum(batch_sizes) / len(batch_sizes), 1) if batch_sizes else 0,
+        'batch_size_p50': _percentile(batch_sizes, 0.50) if batch_sizes else 0,
+        'batch_size_max': max(batch_sizes, default=0),
+        'registrations_per_s': round(len(by_user) / elapsed, 1) if elapsed else 0,
+        'failed': sum(1 for _, internal_id in results if not internal_id),
+        'duplicate_ids': len(internal_ids) - len(set(internal_ids)) + (stored - stored_distinct),
+    }
+    checks = {
+        'все регистрации успешны': rates['failed'] == 0 and stored == len(by_user),
+        'повторы получили тот же internal_id': all(len(ids) == 1 for ids in by_user.values()),
+        'internal_id уникальны': rates['duplicate_ids'] == 0,
+    }
+    return {
+        'scenario': 'burst',
+        'mode': 'in-process',
+        'elapsed_s': round(elapsed, 3),
+        'throughput_steps_per_s': round(len(calls) / elapsed, 1) if elapsed else 0,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'rates': rates,
+        'checks': checks,
+        'steps': _steps_summary(latencies),
+    }
+
+def _run_render_benchmark(args):
+    """Время и память на подготовку клавиатуры к запросу: сборка InlineKeyboardMarkup на каждый вызов
+    (как было) против готовой сериализованной разметки из keyboards."""
+    import tracemalloc
+    from aiogram.utils.payload import prepare_arg
+    import keyboards
+    url = 'https://example.com/promo'
+    cases = {
+        'main_menu_build': lambda: prepare_arg(keyboards._build_main_menu()),
+        'main_menu_cached': lambda: prepare_arg(keyboards.get_main_menu()),
+        'broadcast_kb_build': lambda: prepare_arg(keyboards._build_broadcast_keyboard(url)),
+        'broadcast_kb_cached': lambda: prepare_arg(keyboards.get_broadcast_keyboard(url)),
+    }
+    latencies = {}
+    rates = {}
+    started = time.perf_counter()
+    for name, case in cases.items():
+        case()
+        tracemalloc.start()
+        case()
+        rates[f"{name}_alloc_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        values = latencies[name] = []
+        for _ in range(RENDER_ITERATIONS):
+            call_started = time.perf_counter()
+            case()
+            values.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return {
+        'scenario': 'render',
+        'mode': 'in-process',
+        'elapsed_s': round(elapsed, 3),
+        'throughput_steps_per_s': round(len(cases) * RENDER_ITERATIONS / elapsed, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'rates': rates,
+        'steps': _steps_summary(latencies),
+    }
+
+def _build_bot(args):
+    """Бот и диспетчер с настоящими обработчиками, направленные на заглушку Bot API."""
+    import config
+    config.TELEGRAM_API_SERVER = f"http://127.0.0.1:{args.api_port}"
+    config.METRICS_PORT = None
+    from aiogram import Bot
+    from aiogram.bot.api import TelegramAPIServer
+    from handlers import register_handlers
+    from storage import SQLiteStorage
+    from scheduler import SchedulingDispatcher
+    from metrics import MetricsMiddleware
+    bot = Bot(token=FAKE_TOKEN, server=TelegramAPIServer.from_base(config.TELEGRAM_API_SERVER))
+    dp = SchedulingDispatcher(bot, storage=SQLiteStorage())
+    dp.middleware.setup(MetricsMiddleware())
+    register_handlers(dp)
+    return bot, dp
+
+async def _run_worker(args):
+    """Процесс-воркер сценария с --workers: тот же бот, обновления — от приёмника в процессе сценария."""
+    import config
+    import database
+    from cluster import serve_worker
+    database.DATABASE_PATH = args.db
+    database.init_db()
+    bot, dp = _build_bot(args)
+
+    async def on_shutdown(dp):
+        await dp.scheduler.close(config.SCHEDULER_SHUTDOWN_TIMEOUT)
+        await dp.storage.close()
+        await database.stop_registration_writer()
+        await (await bot.get_session()).close()
+        database.close_db()
+
+    await serve_worker(dp, args.worker_index, args.socket, on_shutdown=on_shutdown)
+
+def _cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+async def _run_scenario(args):
+    if args.scenario == 'render':
+        return _run_render_benchmark(args)
+    if args.scenario in ('export', 'import'):
+        return await _run_db_benchmark(args)
+    if args.scenario == 'ids':
+        return await _run_ids_benchmark(args)
+    if args.scenario == 'burst':
+        return await _run_burst_benchmark(args)
+    import config
+    import database
+    database.DATABASE_PATH = os.path.join(tempfile.mkdtemp(prefix='loadtest-'), 'users.db')
+    from aiogram import Bot, Dispatcher
+    from aiogram.dispatcher.webhook import WebhookRequestHandler, BOT_DISPATCHER_KEY
+    from cluster import ShardRouter
+
+    fake = FakeTelegram(latency=args.latency / 1000, rate_429=args.rate_429)
+    api = web.Application()
+    api.router.add_route('*', '/bot{token}/{method}', fake.handle)
+    api_runner = web.AppRunner(api, access_log=None)
+    await api_runner.setup()
+    await web.TCPSite(api_runner, '127.0.0.1', args.api_port).start()
+
+    database.init_db()
+    if args.seed:
+        for start in range(0, args.seed, 1000):
+            database.register_users_batch.sync([(10 ** 9 + i, f'seed{i}') for i in range(start, min(start + 1000, args.seed))])
+
+    bot, dp = _build_bot(args)
+    router = None
+    if args.workers:
+        # Приёмник в процессе сценария, обработчики — в отдельных процессах на той же базе
+        database.close_db()
+        socket_path = os.path.join(os.path.dirname(database.DATABASE_PATH), 'bot.sock')
+        router = ShardRouter(args.workers, socket_path, lambda index: [
+            sys.executable, os.path.abspath(__file__), '--worker-index', str(index), '--db', database.DATABASE_PATH,
+            '--socket', socket_path, '--api-port', str(args.api_port)])
+        await router.start()
+    else:
+        Dispatcher.set_current(dp)
+        Bot.set_current(bot)
+
+    webhook_runner = None
+    polling = None
+    if args.mode == 'webhook':
+        app = web.Application()
+        if router is not None:
+            app.router.add_post('/webhook', router.handle_webhook)
+        else:
+            app.router.add_route('*', '/webhook', WebhookRequestHandler)
+            app[BOT_DISPATCHER_KEY] = dp
+        webhook_runner = web.AppRunner(app, access_log=None)
+        await webhook_runner.setup()
+        await web.TCPSite(webhook_runner, '127.0.0.1', args.webhook_port).start()
+    elif router is not None:
+        polling = asyncio.create_task(router.poll(bot))
+    else:
+        polling = asyncio.create_task(dp.start_polling(timeout=20, reset_webhook=False))
+
+    harness = Harness(fake, args.mode, f"http://127.0.0.1:{args.webhook_port}/webhook", args.step_timeout)
+    harness.session = ClientSession()
+    started = time.perf_counter()
+    cpu_started = _cpu_seconds(resource.RUSAGE_SELF)
+    if args.scenario == 'users':
+        await asyncio.gather(*(user_session(harness, 1000 + i, args.rounds) for i in range(args.users)))
+    else:
+        await admin_session(harness, config.ADMIN_IDS[0])
+    elapsed = time.perf_counter() - started
+
+    cpu_main = _cpu_seconds(resource.RUSAGE_SELF) - cpu_started
+
+    # Ответ на вебхук приходит после ответа бота пользователю: дожидаемся его, прежде чем закрыть сессию
+    await asyncio.gather(*harness.deliveries, return_exceptions=True)
+    await harness.session.close()
+    if polling is not None and router is not None:
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+    elif polling is not None:
+        dp.stop_polling()
+        await dp.wait_closed()
+        polling.cancel()
+    if webhook_runner is not None:
+        await webhook_runner.cleanup()
+    if router is not None:
+        await router.close(config.SCHEDULER_SHUTDOWN_TIMEOUT)
+    else:
+        await dp.scheduler.close(config.SCHEDULER_SHUTDOWN_TIMEOUT)
+        await dp.storage.close()
+        await database.stop_registration_writer()
+        database.close_db()
+    await (await bot.get_session()).close()
+    await api_runner.cleanup()
+
+    steps = sum(len(values) for name, values in harness.latencies.items() if not name.endswith(':timeout'))
+    # Процесс сценария: заглушка Bot API, пользователи и приёмник (или весь бот без --workers)
+    rates = {'cpu_ms_per_step_main': round(1000 * cpu_main / steps, 3) if steps else 0}
+    if router is not None:
+        # Воркеры уже завершились: учитывается всё их время, включая запуск и остановку
+        rates['cpu_ms_per_step_workers'] = round(1000 * _cpu_seconds(resource.RUSAGE_CHILDREN) / steps, 3) if steps else 0
+        rates['peak_rss_worker_mb'] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    return {
+        'scenario': args.scenario,
+        'mode': f"{args.mode}, воркеров: {args.workers}" if args.workers else args.mode,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_steps_per_s': round(steps / elapsed, 1) if elapsed else 0,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'api_calls': fake.calls,
+        'rates': rates,
+        'steps': _steps_summary(harness.latencies),
+    }
+
+def _child(args, queue):
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    queue.put(asyncio.run(_run_scenario(args)))
+
+def run_scenario(args):
+    """Запуск сценария в отдельном процессе (пиковый RSS меряется для каждого сценария отдельно)."""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_child, args=(args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _print_result(result, previous):
+    print(f"\n== {result['scenario']} ({result['mode']}): {result['throughput_steps_per_s']} шагов/с, "
+          f"{result['elapsed_s']} с, пиковый RSS {result['peak_rss_mb']} МБ")
+    for name, step in result['steps'].items():
+        line = f"  {name:<22} n={step['count']:<6} p50={step['p50_ms']:>9} мс  p95={step['p95_ms']:>9} мс  p99={step['p99_ms']:>9} мс"
+        before = (previous or {}).get('steps', {}).get(name)
+        if before and before['p95_ms']:
+            line += f"  (p95 {100 * (step['p95_ms'] - before['p95_ms']) / before['p95_ms']:+.0f}%)"
+        print(line)
+    for name, rate in result.get('rates', {}).items():
+        print(f"  {name:<22} {rate}")
+    for name, passed in result.get('checks', {}).items():
+        print(f"  {'OK' if passed else 'ОШИБКА':<6} {name}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование бота с заглушкой Telegram Bot API")
+    parser.add_argument('--scenario', choices=['users', 'admin', 'export', 'import', 'render', 'ids', 'burst', 'all'], default='all')
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling')
+    parser.add_argument('--users', type=int, default=200,
+                        help="Одновременных пользователей в сценарии users (в export и import — писателей и читателей, "
+                             "в ids — регистраций, в burst — вызовов register_user)")
+    parser.add_argument('--rounds', type=int, default=1, help="Сколько раз каждый пользователь проходит сессию")
+    parser.add_argument('--seed', type=int, default=1000, help="Пользователей в базе до начала сценария admin (в import — строк в импортируемом файле, "
+                             "в ids — регистрируемых пользователей)")
+    parser.add_argument('--latency', type=float, default=0, help="Задержка ответа заглушки, мс")
+    parser.add_argument('--rate-429', type=float, default=0, help="Доля ответов 429 на отправку сообщений")
+    parser.add_argument('--step-timeout', type=float, default=15, help="Сколько секунд ждать ответа на шаг")
+    parser.add_argument('--journal-mode', default='WAL', help="Режим журнала SQLite в сценариях export и import (WAL, delete)")
+    parser.add_argument('--bench-seconds', type=float, default=3, help="Длительность замера в покое в сценариях export и import")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Воркеров в сценариях users и admin: приёмник раздаёт им обновления по хэшу user_id "
+                             "(0 — бот работает в процессе сценария)")
+    parser.add_argument('--api-port', type=int, default=8181)
+    parser.add_argument('--webhook-port', type=int, default=8182)
+    parser.add_argument('--label', default=None, help="Метка прогона в файле результатов (по умолчанию — ревизия git)")
+    parser.add_argument('--results', default=RESULTS_PATH, help="Файл, куда дописываются результаты")
+    # Запуск процесса-воркера приёмником сценария
+    parser.add_argument('--worker-index', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    parser.add_argument('--socket', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker_index is not None:
+        logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+        asyncio.run(_run_worker(args))
+        return
+
+    history = []
+    if os.path.exists(args.results):
+        with open(args.results, encoding='utf-8') as f:
+            history = json.load(f)
+
+    scenarios = ['users', 'admin'] if args.scenario == 'all' else [args.scenario]
+    run = {'label': args.label or _git_revision(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+           'params': {k: v for k, v in vars(args).items() if k not in ('results', 'label')}, 'results': []}
+    for scenario in scenarios:
+        args.scenario = scenario
+        result = run_scenario(args)
+        previous = next((r for past in reversed(history) for r in past['results']
+                         if r['scenario'] == scenario and r['mode'] == result['mode']), None)
+        _print_result(result, previous)
+        run['results'].append(result)
+
+    history.append(run)
+    with open(args.results, 'w', encoding='utf-8') as f:
+        json.dump(history, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены в {args.results}")
+    if not all(passed for result in run['results'] for passed in result.get('checks', {}).values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
@@ -0,0 +1,171 @@
+import bisect
+import logging
+import threading
+import time
+from aiohttp import web
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_lock = threading.Lock()
+_histograms = {}  # (имя, метка) -> [счётчики по корзинам..., +Inf, сумма, количество]
+_counters = {}  # (имя, метка) -> значение
+_gauges = {}  # имя -> функция, возвращающая {метка: значение}
+_descriptions = {
+    "handler_seconds": "Время обработки обновления по команде/callback_data",
+    "db_query_seconds": "Время выполнения запроса к БД по функции database.py",
+    "broadcast_messages_total": "Сообщения рассылки по результату",
+    "config_pool_misses": "Персональные конфиги, сгенерированные при запросе из-за пустого пула",
+    "scheduler_wait_seconds": "Время ожидания обновления в очереди планировщика по полосам",
+    "scheduler_seconds": "Время от постановки обновления в очередь до конца обработки по полосам",
+}
+
+def observe(name, label, seconds):
+    """Запись длительности в гистограмму name{label}."""
+    index = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        histogram = _histograms.get((name, label))
+        if histogram is None:
+            histogram = _histograms[(name, label)] = [0] * (len(BUCKETS) + 3)
+        histogram[index] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+def inc(name, label, value=1):
+    """Увеличение счётчика name{label}."""
+    with _lock:
+        _counters[(name, label)] = _counters.get((name, label), 0) + value
+
+def register_gauge(name, collect, description=""):
+    """Регистрация показателя, значение которого вычисляется при каждом снятии метрик."""
+    _gauges[name] = collect
+    _descriptions[name] = description
+
+def _quantile(histogram, q):
+    """Оценка квантиля по корзинам гистограммы (верхняя граница корзины)."""
+    rank = q * histogram[-1]
+    seen = 0
+    for bound, count in zip(BUCKETS, histogram):
+        seen += count
+        if seen >= rank:
+            return bound
+    return float('inf')
+
+def _escape_label(value):
+    """Экранирование значения метки по формату Prometheus (\\, \" и перевод строки)."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_prometheus():
+    """Все метрики в текстовом формате Prometheus."""
+    with _lock:
+        histograms = {key: value[:] for key, value in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    described = set()
+    esc = _escape_label
+
+    def header(name, kind):
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {name} {_descriptions.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, label), histogram in sorted(histograms.items()):
+        header(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram):
+            cumulative += count
+            lines.append(f'{name}_bucket{{name="{esc(label)}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{name="{esc(label)}"}} {histogram[-2]}')
+        lines.append(f'{name}_count{{name="{esc(label)}"}} {histogram[-1]}')
+    for (name, label), value in sorted(counters.items()):
+        header(name, "counter")
+        lines.append(f'{name}{{name="{esc(label)}"}} {value}')
+    for name, collect in _gauges.items():
+        header(name, "gauge")
+        for label, value in collect().items():
+            lines.append(f'{name}{{name="{esc(label)}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+def summary_text(limit=10):
+    """Краткая сводка для админ-панели: самые медленные обработчики и запросы, счётчики."""
+    with _lock:
+        histograms = {key: value[:] for key, value in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for name, title in (("handler_seconds", "Обработчики"), ("db_query_seconds", "Запросы к БД"),
+                        ("scheduler_wait_seconds", "Ожидание в очереди"), ("scheduler_seconds", "Очередь и обработка")):
+        rows = [(label, h) for (n, label), h in histograms.items() if n == name]
+        rows.sort(key=lambda row: row[1][-2] / row[1][-1], reverse=True)
+        if rows:
+            lines.append(f"{title} (кол-во / среднее / p95, мс):")
+            for label, h in rows[:limit]:
+                lines.append(f"{label}: {h[-1]} / {h[-2] / h[-1] * 1000:.1f} / {_quantile(h, 0.95) * 1000:g}")
+    rows = sorted((f"{name}[{label}]", value) for (name, label), value in counters.items())
+    if rows:
+        lines.append("Счётчики:")
+        lines.extend(f"{key}: {value}" for key, value in rows)
+    for name, collect in _gauges.items():
+        for label, value in collect().items():
+            lines.append(f"{name}[{label}]: {value}")
+    return "\n".join(lines) or "Метрик пока нет."
+
+def _registered_commands(dispatcher):
+    """Команды из фильтров commands=[...] зарегистрированных обработчиков сообщений."""
+    commands = set()
+    for handler in dispatcher.message_handlers.handlers:
+        for filter_obj in handler.filters or ():
+            commands.update(getattr(filter_obj.filter, 'commands', None) or ())
+    return commands
+
+def _update_label(obj, commands):
+    if isinstance(obj, types.CallbackQuery):
+        return f"callback:{(obj.data or '').split(':')[0]}"
+    if obj.is_command():
+        # Команду пишет пользователь: неизвестные сводятся к одной метке, иначе число меток не ограничено
+        command = obj.get_command(pure=True).lower()
+        return f"command:{command if command in commands else 'other'}"
+    return f"message:{obj.content_type}"
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замер времени обработки каждого сообщения и callback-запроса."""
+
+    def __init__(self):
+        super().__init__()
+        self._commands = None
+
+    def _label(self, obj):
+        if self._commands is None:
+            # Обработчики регистрируются после подключения middleware, поэтому команды собираются при первом обновлении
+            self._commands = _registered_commands(self.manager.dispatcher)
+        return _update_label(obj, self._commands)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        data['_metrics_started'] = time.perf_counter()
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        started = data.get('_metrics_started')
+        if started is not None:
+            observe("handler_seconds", self._label(message), time.perf_counter() - started)
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        data['_metrics_started'] = time.perf_counter()
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        started = data.get('_metrics_started')
+        if started is not None:
+            observe("handler_seconds", self._label(callback_query), time.perf_counter() - started)
+
+async def _metrics_handler(request):
+    return web.Response(text=render_prometheus(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server(host, port):
+    """Запуск HTTP-сервера с /metrics. Возвращает runner для остановки."""
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
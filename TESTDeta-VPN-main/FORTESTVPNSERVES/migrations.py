@@ -0,0 +1,172 @@
+import logging
+import secrets
+from datetime import datetime
+
+def _columns(c, table):
+    c.execute(f"PRAGMA table_info({table})")
+    return [info[1] for info in c.fetchall()]
+
+def _add_column(c, table, column, definition):
+    """Добавление столбца, если его ещё нет (базы, созданные до появления миграций, могут его уже содержать)."""
+    if column in _columns(c, table):
+        return False
+    c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+def _users_and_config(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                (user_id INTEGER PRIMARY KEY,
+                 username TEXT,
+                 internal_id TEXT UNIQUE,
+                 registration_date DATETIME)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS config
+                (id INTEGER PRIMARY KEY,
+                 config_text TEXT)''')
+    # Счётчик версий конфига (по нему обновляется кэш)
+    _add_column(c, 'config', 'version', "INTEGER NOT NULL DEFAULT 1")
+    # Самые старые базы создавались без даты регистрации
+    if _add_column(c, 'users', 'registration_date', "DATETIME"):
+        c.execute("UPDATE users SET registration_date = ?", (datetime.now(),))
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_registration_date ON users (registration_date)")
+
+def _fsm_states(c):
+    # Состояния FSM (хранилище storage.SQLiteStorage), data и bucket — JSON
+    c.execute('''CREATE TABLE IF NOT EXISTS fsm_states
+                (chat_id INTEGER,
+                 user_id INTEGER,
+                 state TEXT,
+                 data TEXT,
+                 bucket TEXT,
+                 updated_at REAL,
+                 PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)")
+
+def _id_sequence(c):
+    # Счётчик для выдачи internal_id; seed задаёт перестановку номеров и не меняется
+    c.execute('''CREATE TABLE IF NOT EXISTS id_sequence
+                (name TEXT PRIMARY KEY,
+                 next_value INTEGER NOT NULL,
+                 seed TEXT NOT NULL)''')
+    c.execute("INSERT OR IGNORE INTO id_sequence (name, next_value, seed) VALUES (?, ?, ?)",
+             ('internal_id', 0, secrets.token_hex(8)))
+
+def _broadcast_jobs(c):
+    # Задания рассылки: курсор — последний user_id, до которого рассылка полностью записана
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 text TEXT,
+                 photo TEXT,
+                 url TEXT,
+                 admin_chat_id INTEGER,
+                 status TEXT NOT NULL DEFAULT 'pending',
+                 cursor INTEGER NOT NULL DEFAULT 0,
+                 total INTEGER NOT NULL DEFAULT 0,
+                 sent INTEGER NOT NULL DEFAULT 0,
+                 failed INTEGER NOT NULL DEFAULT 0,
+                 created_at DATETIME,
+                 finished_at DATETIME)''')
+    # Доставки после курсора (удаляются, когда курсор их перекрывает)
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries
+                (job_id INTEGER,
+                 user_id INTEGER,
+                 error TEXT,
+                 PRIMARY KEY (job_id, user_id)) WITHOUT ROWID''')
+
+def _user_daily_stats(c):
+    # Ежедневные сводки регистраций (обновляются при каждой регистрации)
+    c.execute('''CREATE TABLE IF NOT EXISTS user_daily_stats
+                (day TEXT PRIMARY KEY,
+                 registrations INTEGER NOT NULL DEFAULT 0)''')
+    c.execute("SELECT 1 FROM user_daily_stats LIMIT 1")
+    if not c.fetchone():
+        c.execute('''INSERT INTO user_daily_stats (day, registrations)
+                     SELECT date(registration_date), COUNT(*) FROM users
+                     WHERE registration_date IS NOT NULL
+                     GROUP BY date(registration_date)''')
+
+def _user_delivery_status(c):
+    # Статус доставки: 'active' или 'blocked' (бот заблокирован, аккаунт удалён, чат не найден)
+    _add_column(c, 'users', 'status', "TEXT NOT NULL DEFAULT 'active'")
+    _add_column(c, 'users', 'last_error', "TEXT")
+    _add_column(c, 'users', 'last_contact_at', "DATETIME")
+    # Рассылки и счётчики выбирают пользователей по статусу в порядке user_id
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_status ON users (status, user_id)")
+
+def _config_pool(c):
+    # Персональный конфиг пользователя (NULL — общий конфиг из таблицы config)
+    _add_column(c, 'users', 'config_text', "TEXT")
+    # Заранее подготовленные персональные конфиги: выдаются при регистрации в порядке id
+    c.execute('''CREATE TABLE IF NOT EXISTS config_pool
+                (id INTEGER PRIMARY KEY,
+                 config_text TEXT NOT NULL UNIQUE,
+                 source TEXT NOT NULL,
+                 created_at DATETIME)''')
+
+def _user_search_index(c):
+    # Поиск по началу username без учёта регистра в админ-панели (username COLLATE NOCASE >= ? AND < ?);
+    # поиск по internal_id идёт по уникальному индексу, листание по дате — по idx_users_registration_date
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE)")
+
+def _user_status_counts(c):
+    # Число пользователей по статусам (обновляется при регистрации, импорте и смене статуса)
+    c.execute('''CREATE TABLE IF NOT EXISTS user_status_counts
+                (status TEXT PRIMARY KEY,
+                 users INTEGER NOT NULL DEFAULT 0)''')
+    c.execute("DELETE FROM user_status_counts")
+    c.execute("INSERT INTO user_status_counts (status, users) SELECT status, COUNT(*) FROM users GROUP BY status")
+
+def _user_page_keys(c):
+    # Листание по дате и username в админ-панели сортирует по COALESCE(..., ''), чтобы пользователи
+    # без даты или username (импорт) не выпадали; индексы по тем же выражениям заменяют индекс миграции 8
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_registration_key ON users (COALESCE(registration_date, ''))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_username_key ON users (COALESCE(username, '') COLLATE NOCASE)")
+    c.execute("DROP INDEX IF EXISTS idx_users_username_nocase")
+
+# Номер, описание, функция. Номера только растут; применённую миграцию не меняют — добавляют новую
+MIGRATIONS = [
+    (1, "Пользователи и конфиг", _users_and_config),
+    (2, "Состояния FSM", _fsm_states),
+    (3, "Счётчик internal_id", _id_sequence),
+    (4, "Задания рассылки", _broadcast_jobs),
+    (5, "Ежедневные сводки регистраций", _user_daily_stats),
+    (6, "Статус доставки пользователей", _user_delivery_status),
+    (7, "Пул персональных конфигов", _config_pool),
+    (8, "Индекс поиска по username", _user_search_index),
+    (9, "Счётчики пользователей по статусам", _user_status_counts),
+    (10, "Индексы листания пользователей без даты и username", _user_page_keys),
+]
+
+def get_schema_version(conn):
+    """Номер последней применённой миграции (0 — база без миграций)."""
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def migrate(conn):
+    """Применение недостающих миграций по порядку.
+
+    Каждая миграция выполняется в своей транзакции (BEGIN IMMEDIATE) вместе с записью
+    в schema_version: при ошибке база остаётся на предыдущей версии. Если миграции
+    одновременно запускают несколько процессов, версия перепроверяется внутри транзакции.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                    (version INTEGER PRIMARY KEY,
+                     description TEXT,
+                     applied_at DATETIME)''')
+    current = get_schema_version(conn)
+    for version, description, upgrade in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone():
+                conn.rollback()
+                continue
+            upgrade(conn.cursor())
+            conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                         (version, description, datetime.now()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logging.info(f"Применена миграция {version}: {description}")
+    return get_schema_version(conn)
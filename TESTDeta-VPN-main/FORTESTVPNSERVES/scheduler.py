@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from aiogram import Dispatcher, types
+from config import ADMIN_IDS, SCHEDULER_USER_WORKERS, SCHEDULER_ADMIN_WORKERS
+from metrics import observe, register_gauge
+
+def _update_chat_and_user(update: types.Update):
+    """(chat_id, user_id) обновления; None, если их нет."""
+    for obj in (update.message, update.edited_message, update.callback_query, update.my_chat_member,
+                update.chat_member, update.pre_checkout_query, update.shipping_query, update.inline_query,
+                update.chosen_inline_result, update.chat_join_request):
+        if obj is None:
+            continue
+        user = getattr(obj, 'from_user', None)
+        message = getattr(obj, 'message', None) if isinstance(obj, types.CallbackQuery) else obj
+        chat = getattr(message, 'chat', None)
+        user_id = user.id if user else None
+        chat_id = chat.id if chat else user_id
+        return chat_id, user_id
+    return None, None
+
+class UpdateScheduler:
+    """
+    Планировщик обновлений между приёмом (polling/webhook) и обработчиками.
+
+    Обновления разных чатов обрабатываются параллельно ограниченным числом воркеров,
+    обновления одного чата — строго по очереди (переходы UserState не перемешиваются).
+    Обновления админов идут в отдельную полосу со своими воркерами: долгая выгрузка
+    или запуск рассылки не занимают воркеры, обслуживающие пользователей.
+    """
+
+    def __init__(self, process, workers=None):
+        self.process = process
+        self.workers = workers or {'user': SCHEDULER_USER_WORKERS, 'admin': SCHEDULER_ADMIN_WORKERS}
+        self._chats = {}  # (полоса, chat_id) -> deque[(update, future, время постановки)]
+        self._ready = None  # полоса -> asyncio.Queue ключей чатов, готовых к обработке
+        self._tasks = []
+        self._closed = False  # После close() новые обновления не принимаются
+        self._pending = dict.fromkeys(self.workers, 0)  # Обновлений в очереди по полосам
+        self._active = dict.fromkeys(self.workers, 0)  # Обрабатывается сейчас по полосам
+        register_gauge("scheduler_queue_depth", lambda: dict(self._pending),
+                       "Обновлений в очереди планировщика по полосам")
+        register_gauge("scheduler_active", lambda: dict(self._active),
+                       "Обновлений в обработке по полосам")
+
+    def _start(self):
+        self._ready = {lane: asyncio.Queue() for lane in self.workers}
+        for lane, count in self.workers.items():
+            for _ in range(count):
+                self._tasks.append(asyncio.create_task(self._worker(lane)))
+
+    @staticmethod
+    def lane_for(user_id):
+        return 'admin' if user_id in ADMIN_IDS else 'user'
+
+    async def submit(self, update: types.Update):
+        """Постановка обновления в очередь его чата. Возвращает результат обработки.
+
+        После close() обновление отбрасывается: воркеры не запускаются заново, пока бот
+        закрывает хранилище и базу. В polling Telegram отдаст его снова после перезапуска
+        (смещение подтверждается только следующим getUpdates).
+        """
+        if self._closed:
+            logging.warning(f"Планировщик остановлен, обновление {update.update_id} отброшено")
+            return None
+        if self._ready is None:
+            self._start()
+        chat_id, user_id = _update_chat_and_user(update)
+        lane = self.lane_for(user_id)
+        # Обновления без чата не связаны порядком с другими
+        key = (lane, chat_id if chat_id is not None else f"update:{update.update_id}")
+        future = asyncio.get_running_loop().create_future()
+        queue = self._chats.get(key)
+        if queue is None:
+            queue = self._chats[key] = deque()
+            self._ready[lane].put_nowait(key)
+        queue.append((update, future, time.perf_counter()))
+        self._pending[lane] += 1
+        return await asyncio.shield(future)
+
+    async def _worker(self, lane):
+        ready = self._ready[lane]
+        while True:
+            key = await ready.get()
+            queue = self._chats[key]
+            update, future, queued_at = queue.popleft()
+            self._pending[lane] -= 1
+            self._active[lane] += 1
+            started = time.perf_counter()
+            observe("scheduler_wait_seconds", lane, started - queued_at)
+            try:
+                # Отдельная задача — отдельная копия контекста: aiogram хранит текущее обновление
+                # и состояние FSM в contextvars, они не должны переходить к следующему обновлению воркера
+                result = await asyncio.ensure_future(self.process(update))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._active[lane] -= 1
+                observe("scheduler_seconds", lane, time.perf_counter() - queued_at)
+                # Чат возвращается в конец очереди полосы, чтобы активный чат не задерживал остальные
+                if queue:
+                    ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+
+    def depth(self):
+        """Число обновлений в очереди и в обработке."""
+        return sum(self._pending.values()) + sum(self._active.values())
+
+    async def close(self, timeout):
+        """Дообработка накопленных обновлений (не дольше timeout секунд) и остановка воркеров."""
+        deadline = time.monotonic() + timeout
+        await asyncio.sleep(0)  # Уже созданные задачи с submit успевают поставить обновления в очередь
+        while self.depth() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.depth():
+            logging.warning(f"Планировщик остановлен, не обработано обновлений: {self.depth()}")
+        self._closed = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for queue in self._chats.values():
+            for _, future, _ in queue:
+                future.cancel()
+        self._tasks.clear()
+        self._chats.clear()
+        self._ready = None
+        self._pending = dict.fromkeys(self.workers, 0)
+        self._active = dict.fromkeys(self.workers, 0)
+
+class SchedulingDispatcher(Dispatcher):
+    """Dispatcher, который пропускает каждое обновление (polling и webhook) через UpdateScheduler."""
+
+    def __init__(self, *args, workers=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = UpdateScheduler(super().process_update, workers)
+
+    async def process_update(self, update: types.Update):
+        return await self.scheduler.submit(update)
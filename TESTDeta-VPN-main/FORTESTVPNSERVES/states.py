@@ -4,6 +4,9 @@ class UserState(StatesGroup):
     AwaitingAgreement = State()
     MainMenu = State()
     AwaitingNewConfig = State()
+    AwaitingConfigFile = State()
+    AwaitingImportFile = State()
+    AwaitingUserSearch = State()
     AwaitingBroadcastText = State()
     AwaitingBroadcastPhoto = State()
     AwaitingBroadcastUrl = State()
\ No newline at end of file
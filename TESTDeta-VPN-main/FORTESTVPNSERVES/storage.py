@@ -0,0 +1,194 @@
+import asyncio
+import copy
+import json
+import logging
+import time
+import typing
+from collections import OrderedDict
+from aiogram.dispatcher.storage import BaseStorage
+from database import load_fsm_record, save_fsm_records, delete_stale_fsm_records
+
+FSM_CACHE_SIZE = 10000  # Сколько состояний держать в памяти (LRU)
+FSM_FLUSH_INTERVAL = 1  # Период записи изменённых состояний в БД, секунд
+FSM_STATE_TTL = 30 * 24 * 3600  # Состояния, не менявшиеся дольше, удаляются из БД
+FSM_TOUCH_INTERVAL = 24 * 3600  # Как часто продлевать срок жизни состояния, которое только читают
+FSM_EVICT_INTERVAL = 3600  # Период удаления устаревших состояний, секунд
+
+def _empty_record():
+    return {'state': None, 'data': {}, 'bucket': {}, 'saved_at': 0.0}
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в SQLite.
+
+    Горячие состояния держатся в LRU-кэше ограниченного размера, изменения пишутся
+    в БД пачками в фоне (write-behind), давно не использованные состояния удаляются по TTL.
+    Состояния переживают перезапуск бота.
+    """
+
+    def __init__(self, cache_size=FSM_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # (chat, user) -> запись
+        self._dirty = {}  # (chat, user) -> запись, ожидающая записи в БД
+        self._inflight = {}  # (chat, user) -> запись, которая сейчас пишется в БД
+        self._flush_task = None
+        self._evict_task = None
+
+    def _ensure_tasks(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+            self._evict_task = asyncio.create_task(self._evict_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def _evict_loop(self):
+        while True:
+            deleted = await delete_stale_fsm_records(time.time() - FSM_STATE_TTL)
+            if deleted:
+                logging.info(f"Удалено устаревших состояний FSM: {deleted}")
+            await asyncio.sleep(FSM_EVICT_INTERVAL)
+
+    async def flush(self):
+        """Запись всех изменённых состояний одной транзакцией.
+
+        Пока транзакция не закоммичена, записи остаются в _inflight: вытесненное из кэша состояние
+        иначе перечиталось бы из БД в старом виде.
+        """
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        self._inflight.update(dirty)
+        now = time.time()
+        rows = []
+        for (chat, user), record in dirty.items():
+            record['saved_at'] = now
+            if record['state'] is None and not record['data'] and not record['bucket']:
+                rows.append((chat, user, None, None, None, now))
+            else:
+                rows.append((chat, user, record['state'], json.dumps(record['data']), json.dumps(record['bucket']), now))
+        saved = False
+        try:
+            saved = await save_fsm_records(rows)
+        finally:
+            for key, record in dirty.items():
+                if not saved:
+                    # Не получилось записать — вернём в очередь, если новых изменений не было
+                    self._dirty.setdefault(key, record)
+                if self._inflight.get(key) is record:
+                    del self._inflight[key]
+
+    async def _get(self, chat, user):
+        chat, user = map(int, self.check_address(chat=chat, user=user))
+        key = (chat, user)
+        self._ensure_tasks()
+        record = self._cache.get(key)
+        if record is None:
+            record = self._dirty.get(key) or self._inflight.get(key)
+        if record is None:
+            row = await load_fsm_record(chat, user)
+            # Пока шло чтение, запись могли загрузить, изменить или начать записывать
+            record = self._cache.get(key) or self._dirty.get(key) or self._inflight.get(key)
+            if record is None:
+                record = _empty_record()
+                if row:
+                    record = {'state': row[0], 'data': json.loads(row[1] or '{}'),
+                              'bucket': json.loads(row[2] or '{}'), 'saved_at': row[3]}
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        if time.time() - record['saved_at'] > FSM_TOUCH_INTERVAL and record['saved_at']:
+            self._dirty[key] = record
+        return key, record
+
+    async def close(self):
+        for task in (self._flush_task, self._evict_task):
+            if task is not None:
+                task.cancel()
+        self._flush_task = self._evict_task = None
+        await self.flush()
+        self._cache.clear()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        _, record = await self._get(chat, user)
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        _, record = await self._get(chat, user)
+        return copy.deepcopy(record['data'])
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        if data is None:
+            data = {}
+        key, record = await self._get(chat, user)
+        record['data'].update(data, **kwargs)
+        self._dirty[key] = record
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, record = await self._get(chat, user)
+        record['state'] = self.resolve_state(state)
+        self._dirty[key] = record
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._get(chat, user)
+        record['data'] = copy.deepcopy(data) or {}
+        self._dirty[key] = record
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        key, record = await self._get(chat, user)
+        record['state'] = None
+        if with_data:
+            record['data'] = {}
+        self._dirty[key] = record
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        _, record = await self._get(chat, user)
+        return copy.deepcopy(record['bucket'])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = await self._get(chat, user)
+        record['bucket'] = copy.deepcopy(bucket) or {}
+        self._dirty[key] = record
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        if bucket is None:
+            bucket = {}
+        key, record = await self._get(chat, user)
+        record['bucket'].update(bucket, **kwargs)
+        self._dirty[key] = record
@@ -0,0 +1,73 @@
+import os
+from html.parser import HTMLParser
+from cluster import on_invalidate
+
+TEXTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'texts')
+TEXT_NAMES = ('plus', 'future_plans')  # Тексты, которые обязаны быть в TEXTS_DIR
+# Теги, которые Telegram принимает в parse_mode='HTML'
+ALLOWED_TAGS = {'b', 'strong', 'i', 'em', 'u', 'ins', 's', 'strike', 'del', 'span', 'tg-spoiler', 'a',
+                'code', 'pre', 'blockquote', 'tg-emoji'}
+
+_texts = {}
+
+class _TagChecker(HTMLParser):
+    """Проверка разметки до подмены текстов: с ошибкой в HTML Telegram отклонит каждое сообщение."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ALLOWED_TAGS:
+            raise ValueError(f"тег <{tag}> не поддерживается Telegram")
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag:
+            raise ValueError(f"лишний или незакрытый тег </{tag}>")
+        self.stack.pop()
+
+def _check_html(text):
+    checker = _TagChecker()
+    checker.feed(text)
+    checker.close()
+    if checker.stack:
+        raise ValueError(f"не закрыт тег <{checker.stack[-1]}>")
+
+def _read_text(path):
+    """Текст из файла шаблона; строки, начинающиеся с ##, — комментарии и не отправляются."""
+    with open(path, encoding='utf-8') as f:
+        lines = [line for line in f.read().splitlines() if not line.startswith('##')]
+    return '\n'.join(lines).strip()
+
+def load_texts():
+    """(Пере)загрузка текстов экранов из TEXTS_DIR: каждый файл *.html — текст с именем файла.
+
+    Новый набор подменяет старый целиком и только если все файлы прочитаны, разметка корректна
+    и есть все TEXT_NAMES; иначе бросается ValueError (OSError) и остаются прежние тексты.
+    Возвращает отсортированный список имён загруженных текстов.
+    """
+    global _texts
+    texts = {}
+    for filename in sorted(os.listdir(TEXTS_DIR)):
+        name, extension = os.path.splitext(filename)
+        if extension != '.html':
+            continue
+        text = _read_text(os.path.join(TEXTS_DIR, filename))
+        try:
+            _check_html(text)
+        except ValueError as e:
+            raise ValueError(f"{filename}: {e}")
+        texts[name] = text
+    missing = [name for name in TEXT_NAMES if not texts.get(name)]
+    if missing:
+        raise ValueError(f"нет текстов: {', '.join(missing)}")
+    _texts = texts
+    return sorted(texts)
+
+def get_text(name):
+    """Текст экрана (готовая строка, без сборки на каждый вызов)."""
+    return _texts[name]
+
+load_texts()
+on_invalidate('texts', load_texts)
@@ -0,0 +1,150 @@
+import time
+from array import array
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from config import ADMIN_IDS, THROTTLE_LIMITS, THROTTLE_EDIT_CALLBACKS
+
+THROTTLE_EVICT_INTERVAL = 300  # Как часто удалять пользователей с полностью восстановленными вёдрами, секунд
+THROTTLE_EVICT_CHUNK = 256  # Сколько слотов проверяется за одно обновление во время очистки
+THROTTLE_MESSAGE = "Слишком часто, подождите немного."
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Антифлуд: ведро токенов на каждого пользователя и группу лимитов (callback_data или 'message').
+
+    Состояние хранится компактно: словарь user_id -> номер слота и плоские массивы array
+    с токенами и временем последнего обновления. Токены пополняются лениво при обращении,
+    а пользователи, чьи вёдра уже полностью восстановились, периодически удаляются —
+    память зависит от числа активных пользователей, а не от всех, кто когда-либо писал боту.
+    Очистка идёт по слотам небольшими порциями (THROTTLE_EVICT_CHUNK за обновление),
+    поэтому даже при миллионе пользователей ни одно обновление не ждёт полного прохода.
+
+    Повторное нажатие кнопки, которая отредактировала бы меню тем же текстом
+    (THROTTLE_EDIT_CALLBACKS), отбрасывается без вызова API. Правка запоминается, только если
+    обработчик подтвердил её, записав message_id отредактированного сообщения в аргумент menu_edit.
+    """
+
+    def __init__(self, limits=THROTTLE_LIMITS, edit_callbacks=THROTTLE_EDIT_CALLBACKS):
+        super().__init__()
+        self.groups = list(limits)
+        self.group_index = {name: i for i, name in enumerate(self.groups)}
+        self.rates = [limits[name][0] for name in self.groups]
+        self.capacities = [limits[name][1] for name in self.groups]
+        self.edit_codes = {data: i + 1 for i, data in enumerate(edit_callbacks)}
+        self._slots = {}  # user_id -> слот
+        self._free = []  # освобождённые слоты
+        self._tokens = array('f')  # слот * число групп + группа -> токены
+        self._stamps = array('d')  # слот * число групп + группа -> время пополнения
+        self._last_edit = array('B')  # слот -> код последней кнопки-редактирования (0 — нет)
+        self._last_edit_message = array('q')  # слот -> message_id сообщения, отредактированного ею
+        self._owners = array('q')  # слот -> user_id (0 — слот свободен)
+        self._evicted_at = time.monotonic()
+        self._evict_cursor = None  # следующий слот текущей очистки (None — очистка не идёт)
+
+    def _slot(self, user_id):
+        slot = self._slots.get(user_id)
+        if slot is not None:
+            return slot
+        width = len(self.groups)
+        if self._free:
+            slot = self._free.pop()
+            for group in range(width):
+                self._tokens[slot * width + group] = self.capacities[group]
+                self._stamps[slot * width + group] = 0.0
+            self._last_edit[slot] = 0
+            self._last_edit_message[slot] = 0
+            self._owners[slot] = user_id
+        else:
+            slot = len(self._last_edit)
+            self._tokens.extend(self.capacities)
+            self._stamps.extend([0.0] * width)
+            self._last_edit.append(0)
+            self._last_edit_message.append(0)
+            self._owners.append(user_id)
+        self._slots[user_id] = slot
+        return slot
+
+    def _consume(self, slot, group, now):
+        i = slot * len(self.groups) + group
+        tokens = min(self.capacities[group], self._tokens[i] + (now - self._stamps[i]) * self.rates[group])
+        self._stamps[i] = now
+        if tokens < 1:
+            self._tokens[i] = tokens
+            return False
+        self._tokens[i] = tokens - 1
+        return True
+
+    def evict_idle(self, now=None, limit=None):
+        """Удаление пользователей, у которых все вёдра уже восстановились (они ничем не отличаются от новых).
+
+        Проверяется не больше limit слотов, начиная с места, где остановилась прошлая порция
+        (limit=None — все оставшиеся). Возвращает число удалённых пользователей.
+        """
+        now = now or time.monotonic()
+        width = len(self.groups)
+        start = self._evict_cursor or 0
+        end = len(self._owners) if limit is None else min(len(self._owners), start + limit)
+        evicted = 0
+        for slot in range(start, end):
+            user_id = self._owners[slot]
+            if not user_id:
+                continue
+            for group in range(width):
+                i = slot * width + group
+                if self._tokens[i] + (now - self._stamps[i]) * self.rates[group] < self.capacities[group]:
+                    break
+            else:
+                del self._slots[user_id]
+                self._owners[slot] = 0
+                self._free.append(slot)
+                evicted += 1
+        self._evict_cursor = end if end < len(self._owners) else None
+        return evicted
+
+    def _check(self, user_id, group_name, now):
+        if self._evict_cursor is not None:
+            self.evict_idle(now, THROTTLE_EVICT_CHUNK)
+        elif now - self._evicted_at >= THROTTLE_EVICT_INTERVAL:
+            self._evicted_at = now
+            self._evict_cursor = 0
+        group = self.group_index.get(group_name, self.group_index['default'])
+        return self._consume(self._slot(user_id), group, now)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        user_id = message.from_user.id
+        if user_id in ADMIN_IDS:
+            return
+        if not self._check(user_id, 'message', time.monotonic()):
+            raise CancelHandler()
+        # Новое сообщение обычно означает новое меню — следующая правка уже не будет повтором
+        slot = self._slots.get(user_id)
+        if slot is not None:
+            self._last_edit[slot] = 0
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        user_id = callback_query.from_user.id
+        if user_id in ADMIN_IDS:
+            return
+        callback_data = (callback_query.data or '').split(':')[0]
+        if not self._check(user_id, callback_data, time.monotonic()):
+            await callback_query.answer(THROTTLE_MESSAGE)
+            raise CancelHandler()
+        edit_code = self.edit_codes.get(callback_data)
+        if edit_code is not None:
+            slot = self._slots[user_id]
+            if self._last_edit[slot] == edit_code and callback_query.message is not None and \
+                    self._last_edit_message[slot] == callback_query.message.message_id:
+                # Это сообщение уже показывает этот текст: правка вернула бы MessageNotModified
+                await callback_query.answer()
+                raise CancelHandler()
+            data['_throttling_edit_code'] = edit_code
+            data['menu_edit'] = {}  # Обработчик записывает сюда message_id после успешной правки
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        edit_code = data.get('_throttling_edit_code')
+        message_id = data.get('menu_edit', {}).get('message_id')
+        slot = self._slots.get(callback_query.from_user.id)
+        if edit_code is not None and message_id is not None and slot is not None:
+            self._last_edit[slot] = edit_code
+            self._last_edit_message[slot] = message_id